@@ -1,6 +1,5 @@
 import os
 import shutil
-import subprocess
 
 import click
 import numpy as np
@@ -65,7 +64,7 @@ def _train_pipeline(pipeline_name):
             }
 
     pipeline = PIPELINES[pipeline_name]['train'](SOLUTION_CONFIG)
-    _ = pipeline.fit_transform(data)
+    _ = pipeline.fit_transform(data, **SOLUTION_CONFIG.execution)
 
 
 @action.command()
@@ -88,7 +87,7 @@ def _evaluate_pipeline(pipeline_name):
             }
 
     pipeline = PIPELINES[pipeline_name]['inference'](SOLUTION_CONFIG)
-    output = pipeline.transform(data)
+    output = pipeline.transform(data, **SOLUTION_CONFIG.execution)
     y_true = valid[Y_COLUMNS].values
     y_pred = output['y_pred']
 
@@ -115,7 +114,7 @@ def _predict_pipeline(pipeline_name):
             }
 
     pipeline = PIPELINES[pipeline_name]['inference'](SOLUTION_CONFIG)
-    output = pipeline.transform(data)
+    output = pipeline.transform(data, **SOLUTION_CONFIG.execution)
     y_pred = output['y_pred']
 
     create_submission(params.experiment_dir, '{}_predictions_test.csv'.format(pipeline_name),
@@ -155,6 +154,9 @@ def evaluate_predict_pipeline(pipeline_name):
 @click.option('-p', '--pipeline_name', help='pipeline to be trained', required=True)
 @click.option('-m', '--model_level', help='choices are "first" or "second"', default='second', required=False)
 def train_evaluate_predict_cv_pipeline(pipeline_name, model_level):
+    if bool(params.sgd__incremental):
+        raise ValueError('sgd__incremental would continue each fold from the model of the previous fold, '
+                         'which was trained on the current validation fold, set it to 0 for cv')
     if bool(params.overwrite) and os.path.isdir(params.experiment_dir):
         shutil.rmtree(params.experiment_dir)
 
@@ -204,7 +206,6 @@ def train_evaluate_predict_cv_pipeline(pipeline_name, model_level):
                                                                              i,
                                                                              pipeline_name)
             _fold_save_loop(out_of_fold_predictions, test_submission, i, pipeline_name)
-            _dump_transformers(i, params.n_cv_splits)
 
             fold_scores.append(score)
             valid_predictions_out_of_fold.append(out_of_fold_predictions)
@@ -254,7 +255,6 @@ def train_evaluate_predict_cv_pipeline(pipeline_name, model_level):
                                                                              i,
                                                                              pipeline_name)
             _fold_save_loop(out_of_fold_predictions, test_submission, i, pipeline_name)
-            _dump_transformers(i, params.n_cv_splits)
 
             fold_scores.append(score)
             valid_predictions_out_of_fold.append(out_of_fold_predictions)
@@ -308,11 +308,11 @@ def _fold_fit_loop(data_train, data_valid, data_test, y_valid,
                    i, pipeline_name):
     logger.info('Training...')
     pipeline = PIPELINES[pipeline_name]['train'](SOLUTION_CONFIG)
-    _ = pipeline.fit_transform(data_train)
+    _ = pipeline.fit_transform(data_train, **SOLUTION_CONFIG.execution)
 
     logger.info('Evaluating...')
     pipeline = PIPELINES[pipeline_name]['inference'](SOLUTION_CONFIG)
-    output_valid = pipeline.transform(data_valid)
+    output_valid = pipeline.transform(data_valid, **SOLUTION_CONFIG.execution)
     y_valid_pred = output_valid['y_pred']
     out_of_fold_predictions = create_predictions_df(valid_split, y_valid_pred, Y_COLUMNS)
     out_of_fold_predictions['fold_id'] = i
@@ -321,7 +321,7 @@ def _fold_fit_loop(data_train, data_valid, data_test, y_valid,
     logger.info('Score on fold {} is {}'.format(i, score))
 
     logger.info('Predicting...')
-    output_test = pipeline.transform(data_test)
+    output_test = pipeline.transform(data_test, **SOLUTION_CONFIG.execution)
     y_test_pred = output_test['y_pred']
     test_submission = create_predictions_df(test_split, y_test_pred, Y_COLUMNS)
     test_submission['fold_id'] = i
@@ -330,11 +330,6 @@ def _fold_fit_loop(data_train, data_valid, data_test, y_valid,
     return score, out_of_fold_predictions, test_submission
 
 
-def _dump_transformers(i, nr_splits):
-    if i + 1 != nr_splits:
-        subprocess.call('rm -rf {}/transformers'.format(params.experiment_dir), shell=True)
-
-
 def _fold_save_loop(valid_oof_submission, test_submission, i, pipeline_name):
     logger.info('Saving fold {} oof predictions'.format(i))
     save_submission(valid_oof_submission, params.experiment_dir,
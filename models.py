@@ -1,8 +1,9 @@
+from keras import backend as K
 from keras import regularizers
 from keras.activations import relu
 from keras.callbacks import ModelCheckpoint, EarlyStopping
 from keras.layers import Input, Embedding, PReLU, Bidirectional, Lambda, \
-    CuDNNLSTM, CuDNNGRU, SimpleRNN, Conv1D, Dense, BatchNormalization, Dropout, SpatialDropout1D, \
+    CuDNNLSTM, CuDNNGRU, LSTM, GRU, SimpleRNN, Conv1D, Dense, BatchNormalization, Dropout, SpatialDropout1D, \
     GlobalMaxPool1D, GlobalAveragePooling1D, MaxPooling1D
 from keras.layers.merge import add, concatenate
 from keras.models import Model
@@ -10,7 +11,7 @@ from keras.optimizers import Adam
 
 from steps.keras.callbacks import NeptuneMonitor, ReduceLR
 from steps.keras.contrib import AttentionWeightedAverage
-from steps.keras.models import ClassifierXY
+from steps.keras.models import ClassifierXY, ClassifierBucketing
 from steps.utils import create_filepath
 
 
@@ -31,39 +32,52 @@ class BasicClassifier(ClassifierXY):
         return [neptune, lr_scheduler, early_stopping, model_checkpoint]
 
 
-class CharVDCNN(BasicClassifier):
+class SequenceClassifier(ClassifierBucketing, BasicClassifier):
+    """
+    Note:
+        BasicClassifier trained and evaluated on BucketingSequence flows of token sequences, which are
+        length bucketed when bucketing is set in model_params.
+    """
+
+
+class CharVDCNN(SequenceClassifier):
+    def _get_min_length(self):
+        return 2 ** self.architecture_config['model_params']['repeat_block']
+
     def _build_model(self, embedding_size, maxlen, max_features,
                      filter_nr, kernel_size, repeat_block, dense_size, repeat_dense,
                      max_pooling, mean_pooling, weighted_average_attention, concat_mode,
                      dropout_embedding, conv_dropout, dense_dropout, dropout_mode,
                      conv_kernel_reg_l2, conv_bias_reg_l2,
                      dense_kernel_reg_l2, dense_bias_reg_l2,
-                     use_prelu, use_batch_norm, batch_norm_first):
+                     use_prelu, use_batch_norm, batch_norm_first, bucketing=False):
         return vdcnn(embedding_size, maxlen, max_features,
                      filter_nr, kernel_size, repeat_block, dense_size, repeat_dense,
                      max_pooling, mean_pooling, weighted_average_attention, concat_mode,
                      dropout_embedding, conv_dropout, dense_dropout, dropout_mode,
                      conv_kernel_reg_l2, conv_bias_reg_l2,
                      dense_kernel_reg_l2, dense_bias_reg_l2,
-                     use_prelu, use_batch_norm, batch_norm_first)
+                     use_prelu, use_batch_norm, batch_norm_first, bucketing)
 
 
-class PretrainedEmbeddingModel(BasicClassifier):
+class PretrainedEmbeddingModel(SequenceClassifier):
     def fit(self, embedding_matrix, X, y, validation_data):
-        X_valid, y_valid = validation_data
-        self.callbacks = self._create_callbacks(**self.callbacks_config)
         self.architecture_config['model_params']['embedding_matrix'] = embedding_matrix
-        self.model = self._compile_model(**self.architecture_config)
-        self.model.fit(X, y,
-                       validation_data=[X_valid, y_valid],
-                       callbacks=self.callbacks,
-                       verbose=1,
-                       **self.training_config)
-        return self
+        return super().fit(X, y, validation_data)
 
     def transform(self, embedding_matrix, X, y=None, validation_data=None):
-        predictions = self.model.predict(X, verbose=1)
-        return {'prediction_probability': predictions}
+        return super().transform(X)
+
+    def _get_min_length(self):
+        model_params = self.architecture_config['model_params']
+        if model_params.get('unroll'):
+            return model_params['maxlen']
+        return super()._get_min_length()
+
+    def _get_inference_model_params(self):
+        model_params = super()._get_inference_model_params()
+        model_params.setdefault('embedding_matrix', None)
+        return model_params
 
 
 class WordSCNN(PretrainedEmbeddingModel):
@@ -73,24 +87,27 @@ class WordSCNN(PretrainedEmbeddingModel):
                      dropout_embedding, conv_dropout, dense_dropout, dropout_mode,
                      conv_kernel_reg_l2, conv_bias_reg_l2,
                      dense_kernel_reg_l2, dense_bias_reg_l2,
-                     use_prelu, use_batch_norm, batch_norm_first):
+                     use_prelu, use_batch_norm, batch_norm_first, bucketing=False):
         return scnn(embedding_matrix, embedding_size, trainable_embedding, maxlen, max_features,
                     filter_nr, kernel_size, repeat_block, dense_size, repeat_dense,
                     max_pooling, mean_pooling, weighted_average_attention, concat_mode,
                     dropout_embedding, conv_dropout, dense_dropout, dropout_mode,
                     conv_kernel_reg_l2, conv_bias_reg_l2,
                     dense_kernel_reg_l2, dense_bias_reg_l2,
-                    use_prelu, use_batch_norm, batch_norm_first)
+                    use_prelu, use_batch_norm, batch_norm_first, bucketing)
 
 
 class WordDPCNN(PretrainedEmbeddingModel):
+    def _get_min_length(self):
+        return 2 ** (self.architecture_config['model_params']['repeat_block'] + 1)
+
     def _build_model(self, embedding_matrix, embedding_size, trainable_embedding, maxlen, max_features,
                      filter_nr, kernel_size, repeat_block, dense_size, repeat_dense,
                      max_pooling, mean_pooling, weighted_average_attention, concat_mode,
                      dropout_embedding, conv_dropout, dense_dropout, dropout_mode,
                      conv_kernel_reg_l2, conv_bias_reg_l2,
                      dense_kernel_reg_l2, dense_bias_reg_l2,
-                     use_prelu, use_batch_norm, batch_norm_first):
+                     use_prelu, use_batch_norm, batch_norm_first, bucketing=False):
         """
         Implementation of http://ai.tencent.com/ailab/media/publications/ACL3-Brady.pdf
         """
@@ -100,7 +117,7 @@ class WordDPCNN(PretrainedEmbeddingModel):
                      dropout_embedding, conv_dropout, dense_dropout, dropout_mode,
                      conv_kernel_reg_l2, conv_bias_reg_l2,
                      dense_kernel_reg_l2, dense_bias_reg_l2,
-                     use_prelu, use_batch_norm, batch_norm_first)
+                     use_prelu, use_batch_norm, batch_norm_first, bucketing)
 
 
 class WordCuDNNLSTM(PretrainedEmbeddingModel):
@@ -112,7 +129,7 @@ class WordCuDNNLSTM(PretrainedEmbeddingModel):
                      dropout_embedding, rnn_dropout, dense_dropout, dropout_mode,
                      rnn_kernel_reg_l2, rnn_recurrent_reg_l2, rnn_bias_reg_l2,
                      dense_kernel_reg_l2, dense_bias_reg_l2,
-                     use_prelu, use_batch_norm, batch_norm_first):
+                     use_prelu, use_batch_norm, batch_norm_first, use_cudnn=True, unroll=False, bucketing=False):
         return cudnn_lstm(embedding_matrix, embedding_size, trainable_embedding,
                           maxlen, max_features,
                           unit_nr, repeat_block,
@@ -121,7 +138,7 @@ class WordCuDNNLSTM(PretrainedEmbeddingModel):
                           dropout_embedding, rnn_dropout, dense_dropout, dropout_mode,
                           rnn_kernel_reg_l2, rnn_recurrent_reg_l2, rnn_bias_reg_l2,
                           dense_kernel_reg_l2, dense_bias_reg_l2,
-                          use_prelu, use_batch_norm, batch_norm_first)
+                          use_prelu, use_batch_norm, batch_norm_first, use_cudnn, unroll, bucketing)
 
 
 class WordCuDNNGRU(PretrainedEmbeddingModel):
@@ -133,7 +150,7 @@ class WordCuDNNGRU(PretrainedEmbeddingModel):
                      dropout_embedding, rnn_dropout, dense_dropout, dropout_mode,
                      rnn_kernel_reg_l2, rnn_recurrent_reg_l2, rnn_bias_reg_l2,
                      dense_kernel_reg_l2, dense_bias_reg_l2,
-                     use_prelu, use_batch_norm, batch_norm_first):
+                     use_prelu, use_batch_norm, batch_norm_first, use_cudnn=True, unroll=False, bucketing=False):
         return cudnn_gru(embedding_matrix, embedding_size, trainable_embedding,
                          maxlen, max_features,
                          unit_nr, repeat_block,
@@ -142,7 +159,7 @@ class WordCuDNNGRU(PretrainedEmbeddingModel):
                          dropout_embedding, rnn_dropout, dense_dropout, dropout_mode,
                          rnn_kernel_reg_l2, rnn_recurrent_reg_l2, rnn_bias_reg_l2,
                          dense_kernel_reg_l2, dense_bias_reg_l2,
-                         use_prelu, use_batch_norm, batch_norm_first)
+                         use_prelu, use_batch_norm, batch_norm_first, use_cudnn, unroll, bucketing)
 
 
 class StackerRNN(BasicClassifier):
@@ -152,7 +169,7 @@ class StackerRNN(BasicClassifier):
                      dropout_embedding, rnn_dropout, dense_dropout, dropout_mode,
                      rnn_kernel_reg_l2, rnn_recurrent_reg_l2, rnn_bias_reg_l2,
                      dense_kernel_reg_l2, dense_bias_reg_l2,
-                     use_prelu, use_batch_norm, batch_norm_first):
+                     use_prelu, use_batch_norm, batch_norm_first, use_cudnn=True, unroll=False):
         input_predictions = Input(shape=(6, 16))
 
         x = _dropout(dropout_embedding, dropout_mode)(input_predictions)
@@ -163,7 +180,8 @@ class StackerRNN(BasicClassifier):
                                  recurrent_reg_l2=rnn_recurrent_reg_l2,
                                  bias_reg_l2=rnn_bias_reg_l2,
                                  use_batch_norm=use_batch_norm, batch_norm_first=batch_norm_first,
-                                 dropout=rnn_dropout, dropout_mode=dropout_mode, use_prelu=use_prelu)(x)
+                                 dropout=rnn_dropout, dropout_mode=dropout_mode, use_prelu=use_prelu,
+                                 use_cudnn=use_cudnn, unroll=unroll)(x)
 
         predictions = _classification_block(dense_size=dense_size, repeat_dense=repeat_dense,
                                             max_pooling=max_pooling,
@@ -184,8 +202,8 @@ def scnn(embedding_matrix, embedding_size, trainable_embedding, maxlen, max_feat
          dropout_embedding, conv_dropout, dense_dropout, dropout_mode,
          conv_kernel_reg_l2, conv_bias_reg_l2,
          dense_kernel_reg_l2, dense_bias_reg_l2,
-         use_prelu, use_batch_norm, batch_norm_first):
-    input_text = Input(shape=(maxlen,))
+         use_prelu, use_batch_norm, batch_norm_first, bucketing=False):
+    input_text = Input(shape=(None if bucketing else maxlen,))
     x = Embedding(max_features, embedding_size, weights=[embedding_matrix], trainable=trainable_embedding)(
         input_text)
 
@@ -214,14 +232,14 @@ def dpcnn(embedding_matrix, embedding_size, trainable_embedding, maxlen, max_fea
           dropout_embedding, conv_dropout, dense_dropout, dropout_mode,
           conv_kernel_reg_l2, conv_bias_reg_l2,
           dense_kernel_reg_l2, dense_bias_reg_l2,
-          use_prelu, use_batch_norm, batch_norm_first):
+          use_prelu, use_batch_norm, batch_norm_first, bucketing=False):
     """
     Note:
         Implementation of http://ai.tencent.com/ailab/media/publications/ACL3-Brady.pdf
         post activation is used instead of pre-activation, could be worth exploring
     """
 
-    input_text = Input(shape=(maxlen,))
+    input_text = Input(shape=(None if bucketing else maxlen,))
     if embedding_matrix is not None:
         embedding = Embedding(max_features, embedding_size,
                               weights=[embedding_matrix], trainable=trainable_embedding)(input_text)
@@ -264,8 +282,8 @@ def cudnn_lstm(embedding_matrix, embedding_size, trainable_embedding,
                dropout_embedding, rnn_dropout, dense_dropout, dropout_mode,
                rnn_kernel_reg_l2, rnn_recurrent_reg_l2, rnn_bias_reg_l2,
                dense_kernel_reg_l2, dense_bias_reg_l2,
-               use_prelu, use_batch_norm, batch_norm_first):
-    input_text = Input(shape=(maxlen,))
+               use_prelu, use_batch_norm, batch_norm_first, use_cudnn=True, unroll=False, bucketing=False):
+    input_text = Input(shape=(None if bucketing and not unroll else maxlen,))
     if embedding_matrix is not None:
         x = Embedding(max_features,
                       embedding_size,
@@ -283,7 +301,8 @@ def cudnn_lstm(embedding_matrix, embedding_size, trainable_embedding,
                              recurrent_reg_l2=rnn_recurrent_reg_l2,
                              bias_reg_l2=rnn_bias_reg_l2,
                              use_batch_norm=use_batch_norm, batch_norm_first=batch_norm_first,
-                             dropout=rnn_dropout, dropout_mode=dropout_mode, use_prelu=use_prelu)(x)
+                             dropout=rnn_dropout, dropout_mode=dropout_mode, use_prelu=use_prelu,
+                             use_cudnn=use_cudnn, unroll=unroll)(x)
 
     predictions = _classification_block(dense_size=dense_size, repeat_dense=repeat_dense,
                                         max_pooling=max_pooling,
@@ -306,8 +325,8 @@ def cudnn_gru(embedding_matrix, embedding_size, trainable_embedding,
               dropout_embedding, rnn_dropout, dense_dropout, dropout_mode,
               rnn_kernel_reg_l2, rnn_recurrent_reg_l2, rnn_bias_reg_l2,
               dense_kernel_reg_l2, dense_bias_reg_l2,
-              use_prelu, use_batch_norm, batch_norm_first):
-    input_text = Input(shape=(maxlen,))
+              use_prelu, use_batch_norm, batch_norm_first, use_cudnn=True, unroll=False, bucketing=False):
+    input_text = Input(shape=(None if bucketing and not unroll else maxlen,))
     if embedding_matrix is not None:
         x = Embedding(max_features,
                       embedding_size,
@@ -325,7 +344,8 @@ def cudnn_gru(embedding_matrix, embedding_size, trainable_embedding,
                              recurrent_reg_l2=rnn_recurrent_reg_l2,
                              bias_reg_l2=rnn_bias_reg_l2,
                              use_batch_norm=use_batch_norm, batch_norm_first=batch_norm_first,
-                             dropout=rnn_dropout, dropout_mode=dropout_mode, use_prelu=use_prelu)(x)
+                             dropout=rnn_dropout, dropout_mode=dropout_mode, use_prelu=use_prelu,
+                             use_cudnn=use_cudnn, unroll=unroll)(x)
 
     predictions = _classification_block(dense_size=dense_size, repeat_dense=repeat_dense,
                                         max_pooling=max_pooling,
@@ -346,7 +366,7 @@ def vdcnn(embedding_size, maxlen, max_features,
           dropout_embedding, conv_dropout, dense_dropout, dropout_mode,
           conv_kernel_reg_l2, conv_bias_reg_l2,
           dense_kernel_reg_l2, dense_bias_reg_l2,
-          use_prelu, use_batch_norm, batch_norm_first):
+          use_prelu, use_batch_norm, batch_norm_first, bucketing=False):
     """
     Note:
         Implementation of http://www.aclweb.org/anthology/E17-1104
@@ -354,7 +374,7 @@ def vdcnn(embedding_size, maxlen, max_features,
         intermediate layers.
     """
 
-    input_text = Input(shape=(maxlen,))
+    input_text = Input(shape=(None if bucketing else maxlen,))
     x = Embedding(input_dim=max_features, output_dim=embedding_size)(input_text)
 
     x = _dropout(dropout_embedding, dropout_mode)(x)
@@ -441,9 +461,18 @@ def _dropout(dropout, dropout_mode):
 
 
 def _prelu(use_prelu):
+    """
+    Note:
+        On sequences of variable length, as with bucketing, the alphas are shared over the time axis.
+    """
+
     def f(x):
         if use_prelu:
-            x = PReLU()(x)
+            shape = K.int_shape(x)
+            if len(shape) == 3 and shape[1] is None:
+                x = PReLU(shared_axes=[1])(x)
+            else:
+                x = PReLU()(x)
         else:
             x = Lambda(relu)(x)
         return x
@@ -496,17 +525,27 @@ def _shape_matching_layer(filter_nr, use_prelu, kernel_reg_l2, bias_reg_l2):
 def _cudnn_lstm_block(unit_nr, return_sequences, bidirectional,
                       kernel_reg_l2, recurrent_reg_l2, bias_reg_l2,
                       use_batch_norm, batch_norm_first,
-                      dropout, dropout_mode, use_prelu):
+                      dropout, dropout_mode, use_prelu, use_cudnn=True, unroll=False):
+    """
+    Note:
+        With use_cudnn=False the block is built from a standard LSTM with the CuDNN gate activations,
+        which runs on CPU and loads weights saved from its CuDNNLSTM counterpart.
+    """
+
     def f(x):
-        gru_layer = CuDNNLSTM(uunits=unit_nr, return_sequences=return_sequences,
-                              kernel_regularizer=regularizers.l2(kernel_reg_l2),
-                              recurrent_regularizer=regularizers.l2(recurrent_reg_l2),
-                              bias_regularizer=regularizers.l2(bias_reg_l2)
-                              )
+        layer_params = dict(units=unit_nr, return_sequences=return_sequences,
+                            kernel_regularizer=regularizers.l2(kernel_reg_l2),
+                            recurrent_regularizer=regularizers.l2(recurrent_reg_l2),
+                            bias_regularizer=regularizers.l2(bias_reg_l2)
+                            )
+        if use_cudnn:
+            lstm_layer = CuDNNLSTM(**layer_params)
+        else:
+            lstm_layer = LSTM(recurrent_activation='sigmoid', unroll=unroll, **layer_params)
         if bidirectional:
-            x = Bidirectional(gru_layer)(x)
+            x = Bidirectional(lstm_layer)(x)
         else:
-            x = gru_layer(x)
+            x = lstm_layer(x)
         x = _bn_relu_dropout_block(use_batch_norm=use_batch_norm, batch_norm_first=batch_norm_first,
                                    dropout=dropout, dropout_mode=dropout_mode,
                                    use_prelu=use_prelu)(x)
@@ -518,13 +557,23 @@ def _cudnn_lstm_block(unit_nr, return_sequences, bidirectional,
 def _cudnn_gru_block(unit_nr, return_sequences, bidirectional,
                      kernel_reg_l2, recurrent_reg_l2, bias_reg_l2,
                      use_batch_norm, batch_norm_first,
-                     dropout, dropout_mode, use_prelu):
+                     dropout, dropout_mode, use_prelu, use_cudnn=True, unroll=False):
+    """
+    Note:
+        With use_cudnn=False the block is built from a standard GRU with reset_after and the CuDNN gate
+        activations, which runs on CPU and loads weights saved from its CuDNNGRU counterpart.
+    """
+
     def f(x):
-        gru_layer = CuDNNGRU(units=unit_nr, return_sequences=return_sequences,
-                             kernel_regularizer=regularizers.l2(kernel_reg_l2),
-                             recurrent_regularizer=regularizers.l2(recurrent_reg_l2),
-                             bias_regularizer=regularizers.l2(bias_reg_l2)
-                             )
+        layer_params = dict(units=unit_nr, return_sequences=return_sequences,
+                            kernel_regularizer=regularizers.l2(kernel_reg_l2),
+                            recurrent_regularizer=regularizers.l2(recurrent_reg_l2),
+                            bias_regularizer=regularizers.l2(bias_reg_l2)
+                            )
+        if use_cudnn:
+            gru_layer = CuDNNGRU(**layer_params)
+        else:
+            gru_layer = GRU(reset_after=True, recurrent_activation='sigmoid', unroll=unroll, **layer_params)
         if bidirectional:
             x = Bidirectional(gru_layer)(x)
         else:
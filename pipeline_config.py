@@ -15,6 +15,9 @@ ID_LABEL = ['id']
 
 SOLUTION_CONFIG = AttrDict({
     'env': {'cache_dirpath': params.experiment_dir},
+    'execution': {'num_workers': params.scheduler_workers,
+                  'backend': 'threading'
+                  },
     'xy_splitter': {'x_columns': X_COLUMNS,
                     'y_columns': Y_COLUMNS
                     },
@@ -26,9 +29,16 @@ SOLUTION_CONFIG = AttrDict({
                      'deduplication_threshold': params.deduplication_threshold,
                      'anonymize': bool(params.anonymize),
                      'apostrophes': bool(params.apostrophes),
-                     'use_stopwords': bool(params.use_stopwords)
+                     'use_stopwords': bool(params.use_stopwords),
+                     'num_workers': params.num_workers
                      },
-    'bad_word_filter': {'word_list_filepath': params.bad_words_filepath},
+    'bad_word_filter': {'word_list_filepath': params.bad_words_filepath,
+                        'num_workers': params.num_workers
+                        },
+    'text_counter': {'num_workers': params.num_workers},
+    'token_cache': {'cache_output': bool(params.stream_block_size),
+                    'mmap_output': bool(params.stream_block_size)
+                    },
     'char_tokenizer': {'char_level': True,
                        'maxlen': params.maxlen_char,
                        'num_words': params.max_features_char
@@ -51,9 +61,25 @@ SOLUTION_CONFIG = AttrDict({
                               'ngram_range': (1, 1),
                               'max_features': params.max_features_word
                               },
+    'hashing_char_vectorizer': {'strip_accents': 'unicode',
+                                'analyzer': 'char',
+                                'ngram_range': (1, params.char_ngram_max),
+                                'n_features': params.hashing__n_features,
+                                'alternate_sign': False
+                                },
+    'hashing_word_vectorizer': {'strip_accents': 'unicode',
+                                'analyzer': 'word',
+                                'token_pattern': r'\w{1,}',
+                                'ngram_range': (1, 1),
+                                'n_features': params.hashing__n_features,
+                                'alternate_sign': False
+                                },
     'embeddings': {'pretrained_filepath': params.embedding_filepath,
                    'max_features': params.max_features_word,
-                   'embedding_size': params.word_embedding_size
+                   'embedding_size': params.word_embedding_size,
+                   'store_dirpath': params.embedding_store_dir,
+                   'storage_dtype': params.embedding_storage_dtype,
+                   'num_workers': params.num_workers
                    },
     'dpcnn_network': {
         'architecture_config': {'model_params': {'max_features': params.max_features_word,
@@ -78,6 +104,7 @@ SOLUTION_CONFIG = AttrDict({
                                                  'dense_kernel_reg_l2': params.dense_kernel_reg_l2,
                                                  'dense_bias_reg_l2': params.dense_bias_reg_l2,
                                                  'use_prelu': bool(params.use_prelu),
+                                                 'bucketing': bool(params.bucketing),
                                                  'use_batch_norm': bool(params.use_batch_norm),
                                                  'batch_norm_first': bool(params.batch_norm_first),
                                                  },
@@ -89,6 +116,8 @@ SOLUTION_CONFIG = AttrDict({
         'training_config': {'epochs': params.epochs_nr,
                             'shuffle': True,
                             'batch_size': params.batch_size_train,
+                            'block_size': params.stream_block_size or None,
+                            'workers': params.num_workers,
                             },
         'callbacks_config': {'model_checkpoint': {
             'filepath': os.path.join(params.experiment_dir, 'checkpoints',
@@ -124,6 +153,7 @@ SOLUTION_CONFIG = AttrDict({
                                                  'dense_kernel_reg_l2': params.dense_kernel_reg_l2,
                                                  'dense_bias_reg_l2': params.dense_bias_reg_l2,
                                                  'use_prelu': bool(params.use_prelu),
+                                                 'bucketing': bool(params.bucketing),
                                                  'use_batch_norm': bool(params.use_batch_norm),
                                                  'batch_norm_first': bool(params.batch_norm_first),
                                                  },
@@ -135,6 +165,8 @@ SOLUTION_CONFIG = AttrDict({
         'training_config': {'epochs': params.epochs_nr,
                             'shuffle': True,
                             'batch_size': params.batch_size_train,
+                            'block_size': params.stream_block_size or None,
+                            'workers': params.num_workers,
                             },
         'callbacks_config': {'model_checkpoint': {
             'filepath': os.path.join(params.experiment_dir, 'checkpoints',
@@ -170,6 +202,9 @@ SOLUTION_CONFIG = AttrDict({
                                                  'dense_kernel_reg_l2': params.dense_kernel_reg_l2,
                                                  'dense_bias_reg_l2': params.dense_bias_reg_l2,
                                                  'use_prelu': bool(params.use_prelu),
+                                                 'bucketing': bool(params.bucketing),
+                                                 'use_cudnn': bool(params.use_cudnn),
+                                                 'unroll': bool(params.unroll),
                                                  'use_batch_norm': bool(params.use_batch_norm),
                                                  'batch_norm_first': bool(params.batch_norm_first),
                                                  },
@@ -180,6 +215,8 @@ SOLUTION_CONFIG = AttrDict({
                                 },
         'training_config': {'epochs': params.epochs_nr,
                             'batch_size': params.batch_size_train,
+                            'block_size': params.stream_block_size or None,
+                            'workers': params.num_workers,
                             },
         'callbacks_config': {'model_checkpoint': {
             'filepath': os.path.join(params.experiment_dir, 'checkpoints',
@@ -215,6 +252,9 @@ SOLUTION_CONFIG = AttrDict({
                                                  'dense_kernel_reg_l2': params.dense_kernel_reg_l2,
                                                  'dense_bias_reg_l2': params.dense_bias_reg_l2,
                                                  'use_prelu': bool(params.use_prelu),
+                                                 'bucketing': bool(params.bucketing),
+                                                 'use_cudnn': bool(params.use_cudnn),
+                                                 'unroll': bool(params.unroll),
                                                  'use_batch_norm': bool(params.use_batch_norm),
                                                  'batch_norm_first': bool(params.batch_norm_first),
                                                  },
@@ -225,6 +265,8 @@ SOLUTION_CONFIG = AttrDict({
                                 },
         'training_config': {'epochs': params.epochs_nr,
                             'batch_size': params.batch_size_train,
+                            'block_size': params.stream_block_size or None,
+                            'workers': params.num_workers,
                             },
         'callbacks_config': {'model_checkpoint': {
             'filepath': os.path.join(params.experiment_dir, 'checkpoints',
@@ -259,6 +301,7 @@ SOLUTION_CONFIG = AttrDict({
                                                  'dense_kernel_reg_l2': params.dense_kernel_reg_l2,
                                                  'dense_bias_reg_l2': params.dense_bias_reg_l2,
                                                  'use_prelu': bool(params.use_prelu),
+                                                 'bucketing': bool(params.bucketing),
                                                  'use_batch_norm': bool(params.use_batch_norm),
                                                  'batch_norm_first': bool(params.batch_norm_first),
                                                  },
@@ -269,6 +312,8 @@ SOLUTION_CONFIG = AttrDict({
                                 },
         'training_config': {'epochs': params.epochs_nr,
                             'batch_size': params.batch_size_train,
+                            'block_size': params.stream_block_size or None,
+                            'workers': params.num_workers,
                             },
         'callbacks_config': {'model_checkpoint': {
             'filepath': os.path.join(params.experiment_dir, 'checkpoints',
@@ -300,6 +345,8 @@ SOLUTION_CONFIG = AttrDict({
                                                  'dense_kernel_reg_l2': params.dense_kernel_reg_l2,
                                                  'dense_bias_reg_l2': params.dense_bias_reg_l2,
                                                  'use_prelu': bool(params.use_prelu),
+                                                 'use_cudnn': bool(params.use_cudnn),
+                                                 'unroll': bool(params.unroll),
                                                  'use_batch_norm': bool(params.use_batch_norm),
                                                  'batch_norm_first': bool(params.batch_norm_first),
                                                  },
@@ -327,8 +374,19 @@ SOLUTION_CONFIG = AttrDict({
                                        'penalty': params.log_reg_penalty,
                                        'solver': 'sag',
                                        'max_iter': params.max_iter,
-                                       'n_jobs': params.num_workers,
+                                       'warm_start': bool(params.log_reg_warm_start),
+                                       'num_workers': params.num_workers,
                                        },
+    'sgd_multilabel': {'label_nr': 6,
+                       'loss': 'log',
+                       'penalty': params.sgd__penalty,
+                       'alpha': params.sgd__alpha,
+                       'batch_size': params.sgd__batch_size,
+                       'epochs': params.sgd__epochs,
+                       'incremental': bool(params.sgd__incremental),
+                       'random_state': 1234,
+                       'num_workers': params.num_workers,
+                       },
     'catboost_ensemble': {'label_nr': 6,
                           'iterations': params.catboost__iterations,
                           'learning_rate': params.catboost__learning_rate,
@@ -336,6 +394,7 @@ SOLUTION_CONFIG = AttrDict({
                           'l2_leaf_reg': params.catboost__l2_leaf_reg,
                           'border_count': params.catboost__border_count,
                           'verbose': bool(params.catboost__verbose),
+                          'num_workers': params.num_workers,
                           },
     'blender_ensemble': {'func': multi_roc_auc_score,
                          'min': False,
@@ -354,7 +413,7 @@ SOLUTION_CONFIG = AttrDict({
                          'subsample': params.xgboost__subsample,
                          'reg_lambda': params.xgboost__reg_lambda,
                          'reg_alpha': params.xgboost__reg_alpha,
-                         'n_jobs': params.num_workers},
+                         'num_workers': params.num_workers},
     'clipper': {'lower': eval(params.clipper__lower),
                 'upper': eval(params.clipper__upper)}
 })
@@ -2,12 +2,13 @@ from functools import partial
 
 from models import CharVDCNN, WordSCNN, WordDPCNN, WordCuDNNGRU, WordCuDNNLSTM, StackerRNN
 from postprocessing import Blender
-from steps.base import Step, Dummy, sparse_hstack_inputs, to_tuple_inputs
-from steps.keras.loaders import Tokenizer
+from steps.base import Step, Dummy, sparse_hstack_inputs, hstack_feature_names_inputs, to_tuple_inputs
+from steps.keras.loaders import FastTokenizer
 from steps.keras.models import GloveEmbeddingsMatrix, Word2VecEmbeddingsMatrix, FastTextEmbeddingsMatrix
-from steps.preprocessing import XYSplit, TextCleaner, TfidfVectorizer, WordListFilter, Normalizer, TextCounter, \
-    MinMaxScaler, MinMaxScalerMultilabel
-from steps.sklearn.models import LogisticRegressionMultilabel, CatboostClassifierMultilabel, XGBoostClassifierMultilabel
+from steps.preprocessing import XYSplit, TextCleaner, TfidfVectorizer, HashingVectorizer, WordListFilter, Normalizer, \
+    TextCounter, MinMaxScaler, MinMaxScalerMultilabel
+from steps.sklearn.models import LogisticRegressionMultilabel, SGDClassifierMultilabel, CatboostClassifierMultilabel, \
+    XGBoostClassifierMultilabel
 
 
 def tfidf_logreg(config):
@@ -20,6 +21,9 @@ def tfidf_logreg(config):
                         adapter={'X': ([('tfidf_char_vectorizer', 'features'),
                                         ('tfidf_word_vectorizer', 'features')], sparse_hstack_inputs),
                                  'y': ([('cleaning_output', 'y')]),
+                                 'feature_names': ([('tfidf_char_vectorizer', 'feature_names'),
+                                                    ('tfidf_word_vectorizer', 'feature_names')],
+                                                   hstack_feature_names_inputs),
                                  },
                         cache_dirpath=config.env.cache_dirpath)
     output = Step(name='tfidf_logreg_output',
@@ -31,6 +35,27 @@ def tfidf_logreg(config):
     return output
 
 
+def hashing_sgd(config):
+    preprocessed_input = _preprocessing(config, is_train=False)
+    hashing_char_vectorizer, hashing_word_vectorizer = _hashing(preprocessed_input, config)
+
+    hashing_sgd = Step(name='hashing_sgd',
+                       transformer=SGDClassifierMultilabel(**config.sgd_multilabel),
+                       input_steps=[preprocessed_input, hashing_char_vectorizer, hashing_word_vectorizer],
+                       adapter={'X': ([('hashing_char_vectorizer', 'features'),
+                                       ('hashing_word_vectorizer', 'features')], to_tuple_inputs),
+                                'y': ([('cleaning_output', 'y')]),
+                                },
+                       cache_dirpath=config.env.cache_dirpath)
+    output = Step(name='hashing_sgd_output',
+                  transformer=Dummy(),
+                  input_steps=[hashing_sgd],
+                  adapter={'y_pred': ([('hashing_sgd', 'prediction_probability')]),
+                           },
+                  cache_dirpath=config.env.cache_dirpath)
+    return output
+
+
 def bad_word_logreg(config):
     preprocessed_input = _preprocessing(config, is_train=False)
     tfidf_word_vectorizer = _bad_word_tfidf(preprocessed_input, config)
@@ -40,6 +65,7 @@ def bad_word_logreg(config):
                            input_steps=[preprocessed_input, tfidf_word_vectorizer],
                            adapter={'X': ([('bad_word_tfidf_word_vectorizer', 'features')]),
                                     'y': ([('cleaning_output', 'y')]),
+                                    'feature_names': ([('bad_word_tfidf_word_vectorizer', 'feature_names')]),
                                     },
                            cache_dirpath=config.env.cache_dirpath)
     output = Step(name='bad_word_logreg_output',
@@ -814,8 +840,10 @@ def _preprocessing(config, is_train=True):
 def _char_tokenizer(preprocessed_input, config, is_train=True):
     if is_train:
         char_tokenizer = Step(name='char_tokenizer',
-                              transformer=Tokenizer(**config.char_tokenizer),
+                              transformer=FastTokenizer(**config.char_tokenizer),
                               input_steps=[preprocessed_input],
+                              cache_output=config.token_cache.cache_output,
+                              mmap_output=config.token_cache.mmap_output,
                               adapter={'X': ([('cleaning_output', 'X')]),
                                        'X_valid': ([('cleaning_output', 'X_valid')]),
                                        'train_mode': ([('cleaning_output', 'train_mode')])
@@ -823,8 +851,10 @@ def _char_tokenizer(preprocessed_input, config, is_train=True):
                               cache_dirpath=config.env.cache_dirpath)
     else:
         char_tokenizer = Step(name='char_tokenizer',
-                              transformer=Tokenizer(**config.char_tokenizer),
+                              transformer=FastTokenizer(**config.char_tokenizer),
                               input_steps=[preprocessed_input],
+                              cache_output=config.token_cache.cache_output,
+                              mmap_output=config.token_cache.mmap_output,
                               adapter={'X': ([('cleaning_output', 'X')]),
                                        'train_mode': ([('cleaning_output', 'train_mode')])
                                        },
@@ -835,8 +865,10 @@ def _char_tokenizer(preprocessed_input, config, is_train=True):
 def _word_tokenizer(preprocessed_input, config, is_train=True):
     if is_train:
         word_tokenizer = Step(name='word_tokenizer',
-                              transformer=Tokenizer(**config.word_tokenizer),
+                              transformer=FastTokenizer(**config.word_tokenizer),
                               input_steps=[preprocessed_input],
+                              cache_output=config.token_cache.cache_output,
+                              mmap_output=config.token_cache.mmap_output,
                               adapter={'X': ([('cleaning_output', 'X')]),
                                        'train_mode': ([('cleaning_output', 'train_mode')]),
                                        'X_valid': ([('cleaning_output', 'X_valid')])
@@ -844,8 +876,10 @@ def _word_tokenizer(preprocessed_input, config, is_train=True):
                               cache_dirpath=config.env.cache_dirpath)
     else:
         word_tokenizer = Step(name='word_tokenizer',
-                              transformer=Tokenizer(**config.word_tokenizer),
+                              transformer=FastTokenizer(**config.word_tokenizer),
                               input_steps=[preprocessed_input],
+                              cache_output=config.token_cache.cache_output,
+                              mmap_output=config.token_cache.mmap_output,
                               adapter={'X': ([('cleaning_output', 'X')]),
                                        'train_mode': ([('cleaning_output', 'train_mode')])
                                        },
@@ -899,6 +933,22 @@ def _tfidf(preprocessed_input, config):
     return tfidf_char_vectorizer, tfidf_word_vectorizer
 
 
+def _hashing(preprocessed_input, config):
+    hashing_char_vectorizer = Step(name='hashing_char_vectorizer',
+                                   transformer=HashingVectorizer(**config.hashing_char_vectorizer),
+                                   input_steps=[preprocessed_input],
+                                   adapter={'text': ([('cleaning_output', 'X')]),
+                                            },
+                                   cache_dirpath=config.env.cache_dirpath)
+    hashing_word_vectorizer = Step(name='hashing_word_vectorizer',
+                                   transformer=HashingVectorizer(**config.hashing_word_vectorizer),
+                                   input_steps=[preprocessed_input],
+                                   adapter={'text': ([('cleaning_output', 'X')]),
+                                            },
+                                   cache_dirpath=config.env.cache_dirpath)
+    return hashing_char_vectorizer, hashing_word_vectorizer
+
+
 def _bad_word_tfidf(preprocessed_input, config):
     bad_word_filter = Step(name='bad_word_filter',
                            transformer=WordListFilter(**config.bad_word_filter),
@@ -926,7 +976,7 @@ def _count_features(config):
                     cache_dirpath=config.env.cache_dirpath)
 
     text_counter = Step(name='text_counter',
-                        transformer=TextCounter(),
+                        transformer=TextCounter(**config.text_counter),
                         input_steps=[xy_split],
                         adapter={'X': ([('xy_split', 'X')])},
                         cache_dirpath=config.env.cache_dirpath)
@@ -972,6 +1022,8 @@ PIPELINES = {'fasttext_gru': {'train': partial(fasttext_gru, is_train=True),
 
              'tfidf_logreg': {'train': tfidf_logreg,
                               'inference': tfidf_logreg},
+             'hashing_sgd': {'train': hashing_sgd,
+                             'inference': hashing_sgd},
              'bad_word_logreg': {'train': bad_word_logreg,
                                  'inference': bad_word_logreg},
              'count_logreg': {'train': count_features_logreg,
@@ -1,19 +1,28 @@
+import copy
+import json
 import os
 import pprint
+import time
+from concurrent import futures
+from datetime import datetime
 
 import numpy as np
 from scipy import sparse
 from sklearn.externals import joblib
 
-from steps.utils import view_graph, plot_graph
+from steps.utils import view_graph, plot_graph, hash_object, hash_file, get_transformer_fingerprint, \
+    save_output, load_output, create_filepath, get_peak_rss, get_path_size, get_output_size, format_profile, \
+    format_profile_label
 from utils import get_logger
 
 logger = get_logger()
 
+BACKENDS = ('threading', 'multiprocessing')
+
 
 class Step:
     def __init__(self, name, transformer, input_steps=[], input_data=[], adapter=None, cache_dirpath=None,
-                 cache_output=False, overwrite_transformer=False, save_graph=False):
+                 cache_output=False, mmap_output=False, overwrite_transformer=False, save_graph=False):
         self.name = name
         self.transformer = transformer
 
@@ -23,24 +32,31 @@ class Step:
 
         self.overwrite_transformer = overwrite_transformer
         self.cache_output = cache_output
+        self.mmap_output = mmap_output
 
         self.cache_dirpath = cache_dirpath
         self._prep_cache(cache_dirpath)
+        self.fingerprint = None
+        self.reuse_transformer = False
 
         if save_graph:
+            os.makedirs(self.cache_dirpath, exist_ok=True)
             graph_filepath = os.path.join(self.cache_dirpath, '{}_graph.json'.format(self.name))
             logger.info('Saving graph to {}'.format(graph_filepath))
             joblib.dump(self.graph_info, graph_filepath)
 
     def _prep_cache(self, cache_dirpath):
-        for dirname in ['transformers', 'outputs']:
-            os.makedirs(os.path.join(cache_dirpath, dirname), exist_ok=True)
-
         self.cache_dirpath_transformers = os.path.join(cache_dirpath, 'transformers')
         self.save_dirpath_outputs = os.path.join(cache_dirpath, 'outputs')
+        self.cache_dirpath_fingerprints = os.path.join(cache_dirpath, 'fingerprints')
 
         self.cache_filepath_step_transformer = os.path.join(self.cache_dirpath_transformers, self.name)
-        self.save_filepath_step_output = os.path.join(self.save_dirpath_outputs, '{}'.format(self.name))
+        self.save_dirpath_step_outputs = os.path.join(self.save_dirpath_outputs, self.name)
+        self.cache_filepath_step_fingerprint = os.path.join(self.cache_dirpath_fingerprints, self.name)
+
+    @property
+    def save_filepath_step_output(self):
+        return os.path.join(self.save_dirpath_step_outputs, self.fingerprint)
 
     @property
     def named_steps(self):
@@ -53,84 +69,319 @@ class Step:
     def transformer_is_cached(self):
         return os.path.exists(self.cache_filepath_step_transformer)
 
+    @property
+    def transformer_is_up_to_date(self):
+        return self.transformer_is_cached and self._load_fingerprint().get('inputs') == self.fingerprint
+
     @property
     def output_is_cached(self):
         return os.path.exists(self.save_filepath_step_output)
 
-    def fit_transform(self, data):
-        if self.output_is_cached and self.cache_output and not self.overwrite_transformer:
-            logger.info('step {} loading output...'.format(self.name))
-            step_output_data = self._load_output()
+    def fit_transform(self, data, num_workers=1, backend='threading'):
+        return self._execute(data, fit=True, num_workers=num_workers, backend=backend)
+
+    def transform(self, data, num_workers=1, backend='threading'):
+        return self._execute(data, fit=False, num_workers=num_workers, backend=backend)
+
+    def _execute(self, data, fit, num_workers, backend):
+        """
+        Note:
+            The graph is sorted topologically and every step is executed exactly once per run,
+            even if it is reached through several paths. With num_workers > 1 the steps whose inputs
+            are ready are dispatched to a thread ('threading') or process ('multiprocessing') pool,
+            so that independent branches run concurrently. Outputs are kept only until the last
+            consumer of a step has been executed.
+
+            Steps like TextCleaner or the multilabel estimators start their own pools of workers, so the
+            scheduler workers multiply with theirs. Keep num_workers at 1 when the steps are parallel
+            themselves, which also avoids forking process pools from the scheduler threads.
+        """
+        _check_backend(backend)
+        self._fingerprint_steps(data, fit)
+        plan = self._get_execution_plan(fit)
+        if not fit:
+            self._check_transformers_are_cached(plan)
+        dependencies = self._get_dependencies(plan, fit)
+        consumers_left = {step: 0 for step in plan}
+        for step in plan:
+            for input_step in dependencies[step]:
+                consumers_left[input_step] += 1
+
+        step_outputs, self.run_profile = {}, []
+
+        def release_inputs(step):
+            for input_step in dependencies[step]:
+                consumers_left[input_step] -= 1
+                if consumers_left[input_step] == 0 and input_step is not self:
+                    step_outputs.pop(input_step, None)
+
+        if num_workers <= 1:
+            for step in plan:
+                step_inputs = step._gather_inputs(data, step_outputs, fit)
+                step_outputs[step], step_profile = _compute_step(step, step_inputs, fit)
+                self.run_profile.append(step_profile)
+                release_inputs(step)
+            self._report_profile(fit)
+            return step_outputs[self]
+
+        logger.info('executing {} steps with {} {} workers'.format(len(plan), num_workers, backend))
+        waiting = list(plan)
+        running = {}
+        with _get_executor(num_workers, backend) as executor:
+            while waiting or running:
+                for step in list(waiting):
+                    if all(input_step in step_outputs for input_step in dependencies[step]):
+                        waiting.remove(step)
+                        step_inputs = step._gather_inputs(data, step_outputs, fit)
+                        if backend == 'multiprocessing':
+                            step_to_run = step._detached()
+                        else:
+                            step_to_run = step
+                        running[executor.submit(_compute_step, step_to_run, step_inputs, fit)] = step
+                done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    step_outputs[step], step_profile = future.result()
+                    self.run_profile.append(step_profile)
+                    release_inputs(step)
+        self._report_profile(fit)
+        return step_outputs[self]
+
+    def _fingerprint_steps(self, data, fit):
+        """
+        Note:
+            The fingerprint of a step hashes the constructor config of its transformer, its adapter,
+            the fingerprints of its input steps and the raw input data it reads, so it changes whenever
+            anything upstream changes. When a step is only transformed, the content hash of its fitted
+            transformer is included as well. Outputs are cached under the fingerprint and a transformer
+            is refitted only if it was fitted on inputs with a different fingerprint.
+            A step sharing its name with a step earlier in the order shares its transformer file, so it
+            is never fitted itself but reuses the transformer of its namesake, whose fingerprint it includes.
+        """
+        data_fingerprints, fingerprints_by_name = {}, {}
+        for step in self._get_topological_order():
+            input_data_fingerprints = []
+            for input_data_part in step.input_data or []:
+                if input_data_part not in data_fingerprints:
+                    data_fingerprints[input_data_part] = hash_object(data[input_data_part])
+                input_data_fingerprints.append(data_fingerprints[input_data_part])
+
+            fingerprint = {'name': step.name,
+                           'transformer': get_transformer_fingerprint(step.transformer),
+                           'adapter': step.adapter,
+                           'input_steps': [input_step.fingerprint for input_step in step.input_steps],
+                           'input_data': input_data_fingerprints}
+            if not fit:
+                fingerprint['fitted_transformer'] = step._load_fingerprint().get('transformer')
+            step.reuse_transformer = step.name in fingerprints_by_name
+            if step.reuse_transformer:
+                fingerprint['namesake'] = fingerprints_by_name[step.name]
+            step.fingerprint = hash_object(fingerprint)
+            fingerprints_by_name.setdefault(step.name, step.fingerprint)
+
+    def _get_topological_order(self):
+        order, visited = [], set()
+
+        def visit(step):
+            if step in visited:
+                return
+            visited.add(step)
+            for input_step in step.input_steps:
+                visit(input_step)
+            order.append(step)
+
+        visit(self)
+        return order
+
+    def _get_execution_plan(self, fit):
+        """
+        Returns the steps needed for this run in topological order.
+        Inputs of a step that can load its output from cache are not needed, so they are not visited.
+        """
+        plan, visited = [], set()
+
+        def visit(step):
+            if step in visited:
+                return
+            visited.add(step)
+            if not step._output_is_loadable(fit):
+                for input_step in step.input_steps:
+                    visit(input_step)
+            plan.append(step)
+
+        visit(self)
+        return plan
+
+    def _check_transformers_are_cached(self, plan):
+        """
+        Note:
+            transform never fits anything, so every step that has to be computed needs a fitted transformer.
+            Fail before any work is done rather than after the expensive upstream steps.
+        """
+        missing = [step.name for step in plan if not step._output_is_loadable(False) and not step.transformer_is_cached]
+        if missing:
+            raise ValueError('No transformer cached {}'.format(', '.join(missing)))
+
+    def _get_dependencies(self, plan, fit):
+        """
+        Note:
+            Steps sharing a name share their cache files (e.g. minmax_scaler in rnn_ensemble loads
+            the transformer fitted by its namesake), so they are chained in the order they were planned,
+            which follows the topological order the first namesake is fitted in.
+        """
+        dependencies, last_step_by_name = {}, {}
+        for step in plan:
+            if step._output_is_loadable(fit):
+                dependencies[step] = []
+            else:
+                dependencies[step] = list(step.input_steps)
+            if step.name in last_step_by_name:
+                dependencies[step].append(last_step_by_name[step.name])
+            last_step_by_name[step.name] = step
+        return dependencies
+
+    def _output_is_loadable(self, fit):
+        if fit:
+            return self.output_is_cached and self.cache_output and not self.overwrite_transformer
         else:
-            step_inputs = {}
-            if self.input_data is not None:
-                for input_data_part in self.input_data:
-                    step_inputs[input_data_part] = data[input_data_part]
+            return self.output_is_cached and self.cache_output
 
-            for input_step in self.input_steps:
-                step_inputs[input_step.name] = input_step.fit_transform(data)
+    def _gather_inputs(self, data, step_outputs, fit):
+        if self._output_is_loadable(fit):
+            return None
 
-            if self.adapter:
-                step_inputs = self.adapt(step_inputs)
-            else:
-                step_inputs = self.unpack(step_inputs)
+        step_inputs = {}
+        if self.input_data is not None:
+            for input_data_part in self.input_data:
+                step_inputs[input_data_part] = data[input_data_part]
+
+        for input_step in self.input_steps:
+            step_inputs[input_step.name] = step_outputs[input_step]
+
+        if self.adapter:
+            step_inputs = self.adapt(step_inputs)
+        else:
+            step_inputs = self.unpack(step_inputs)
+        return step_inputs
+
+    def _compute(self, step_inputs, fit):
+        """
+        Note:
+            Besides computing the output, fills self.profile with the wall and cpu time of the step,
+            the growth of the peak resident memory of the process, the size of the output,
+            the bytes read from and written to the cache and whether the cache was hit.
+            cpu time is measured for the whole process, so with the threading backend it also
+            accounts for the steps running concurrently.
+        """
+        self.profile = {'name': self.name,
+                        'cache': 'miss',
+                        'bytes_read': 0,
+                        'bytes_written': 0}
+        start_wall_time, start_cpu_time, start_peak_rss = time.time(), time.process_time(), get_peak_rss()
+
+        if step_inputs is None:
+            logger.info('step {} loading output...'.format(self.name))
+            self.profile['cache'] = 'output'
+            step_output_data = self._load_output()
+        elif fit and not self.reuse_transformer:
             step_output_data = self._cached_fit_transform(step_inputs)
+        else:
+            step_output_data = self._cached_transform(step_inputs)
+
+        self.profile['wall_time'] = time.time() - start_wall_time
+        self.profile['cpu_time'] = time.process_time() - start_cpu_time
+        self.profile['peak_rss_delta'] = get_peak_rss() - start_peak_rss
+        self.profile['output_size'] = get_output_size(step_output_data)
         return step_output_data
 
+    def _report_profile(self, fit):
+        logger.info('pipeline {} profile\n{}'.format(self.name, format_profile(self.run_profile)))
+        profile_filepath = os.path.join(self.cache_dirpath, 'profiles', '{}_{}_{}.json'.format(
+            self.name, 'fit_transform' if fit else 'transform', datetime.now().strftime('%Y%m%d_%H%M%S_%f')))
+        self.save_profile(profile_filepath)
+
+    def save_profile(self, filepath):
+        create_filepath(filepath)
+        with open(filepath, 'w') as f:
+            json.dump(self.run_profile, f, indent=2)
+
+    def _detached(self):
+        """Shallow copy without the upstream graph, so that it is cheap to send to a worker process"""
+        step = copy.copy(self)
+        step.input_steps = []
+        return step
+
     def _cached_fit_transform(self, step_inputs):
-        if self.transformer_is_cached and not self.overwrite_transformer:
+        if self.transformer_is_up_to_date and not self.overwrite_transformer:
             logger.info('step {} loading transformer...'.format(self.name))
-            self.transformer.load(self.cache_filepath_step_transformer)
+            self._load_transformer()
             logger.info('step {} transforming...'.format(self.name))
             step_output_data = self.transformer.transform(**step_inputs)
             if self.cache_output:
                 logger.info('step {} saving outputs...'.format(self.name))
-                self._save_output(step_output_data)
+                step_output_data = self._save_output(step_output_data)
         else:
+            if self.transformer_is_cached and not self.overwrite_transformer:
+                self.transformer.warm_start_from(self.cache_filepath_step_transformer)
             logger.info('step {} fitting and transforming...'.format(self.name))
             step_output_data = self.transformer.fit_transform(**step_inputs)
             logger.info('step {} saving transformer...'.format(self.name))
-            self.transformer.save(self.cache_filepath_step_transformer)
+            self._save_transformer()
+            self._save_fingerprint()
             if self.cache_output:
                 logger.info('step {} saving outputs...'.format(self.name))
-                self._save_output(step_output_data)
+                step_output_data = self._save_output(step_output_data)
         return step_output_data
 
-    def _load_output(self):
-        return joblib.load(self.save_filepath_step_output)
-
-    def _save_output(self, output_data):
-        joblib.dump(output_data, self.save_filepath_step_output)
+    def _load_transformer(self):
+        self.transformer.load(self.cache_filepath_step_transformer)
+        self.profile['cache'] = 'transformer'
+        self.profile['bytes_read'] += get_path_size(self.cache_filepath_step_transformer)
 
-    def transform(self, data):
-        if self.output_is_cached and self.cache_output:
-            logger.info('step {} loading output...'.format(self.name))
-            step_output_data = self._load_output()
-        else:
-            step_inputs = {}
-            if self.input_data is not None:
-                for input_data_part in self.input_data:
-                    step_inputs[input_data_part] = data[input_data_part]
+    def _save_transformer(self):
+        os.makedirs(self.cache_dirpath_transformers, exist_ok=True)
+        self.transformer.save(self.cache_filepath_step_transformer)
+        self.profile['bytes_written'] += get_path_size(self.cache_filepath_step_transformer)
 
-            for input_step in self.input_steps:
-                step_inputs[input_step.name] = input_step.fit_transform(data)
+    def _load_output(self):
+        self.profile['bytes_read'] += get_path_size(self.save_filepath_step_output)
+        return load_output(self.save_filepath_step_output, mmap_mode='r' if self.mmap_output else None)
 
-            if self.adapter:
-                step_inputs = self.adapt(step_inputs)
-            else:
-                step_inputs = self.unpack(step_inputs)
-            step_output_data = self._cached_transform(step_inputs)
-        return step_output_data
+    def _save_output(self, output_data):
+        """
+        Note:
+            Returns the output to hand downstream, with mmap_output that is the saved output loaded
+            memory mapped, so that the in-memory copy can be released.
+        """
+        os.makedirs(self.save_dirpath_step_outputs, exist_ok=True)
+        save_output(output_data, self.save_filepath_step_output)
+        self.profile['bytes_written'] += get_path_size(self.save_filepath_step_output)
+        if self.mmap_output:
+            return self._load_output()
+        return output_data
+
+    def _load_fingerprint(self):
+        if not os.path.exists(self.cache_filepath_step_fingerprint):
+            return {}
+        with open(self.cache_filepath_step_fingerprint) as f:
+            return json.load(f)
+
+    def _save_fingerprint(self):
+        fingerprint = {'inputs': self.fingerprint,
+                       'transformer': hash_file(self.cache_filepath_step_transformer)}
+        os.makedirs(self.cache_dirpath_fingerprints, exist_ok=True)
+        with open(self.cache_filepath_step_fingerprint, 'w') as f:
+            json.dump(fingerprint, f)
 
     def _cached_transform(self, step_inputs):
         if self.transformer_is_cached:
             logger.info('step {} loading transformer...'.format(self.name))
-            self.transformer.load(self.cache_filepath_step_transformer)
+            self._load_transformer()
             logger.info('step {} transforming...'.format(self.name))
             step_output_data = self.transformer.transform(**step_inputs)
             if self.cache_output:
                 logger.info('step {} saving outputs...'.format(self.name))
-                self._save_output(step_output_data)
+                step_output_data = self._save_output(step_output_data)
         else:
             raise ValueError('No transformer cached {}'.format(self.name))
         return step_output_data
@@ -192,8 +443,16 @@ class Step:
             graph_info['edges'].add((input_data, self.name))
         return graph_info
 
-    def plot_graph(self, filepath):
-        plot_graph(self.graph_info, filepath)
+    def plot_graph(self, filepath, with_profile=False):
+        """
+        Note:
+            with_profile=True annotates every node with the profile of the last run of this pipeline.
+        """
+        node_labels = None
+        if with_profile:
+            node_labels = {step_profile['name']: format_profile_label(step_profile)
+                           for step_profile in self.run_profile}
+        plot_graph(self.graph_info, filepath, node_labels)
 
     def __str__(self):
         return pprint.pformat(self.graph_info)
@@ -203,6 +462,11 @@ class Step:
 
 
 class BaseTransformer:
+    def __new__(cls, *args, **kwargs):
+        transformer = super().__new__(cls)
+        transformer.init_params = {'args': args, 'kwargs': kwargs}
+        return transformer
+
     def fit(self, *args, **kwargs):
         return self
 
@@ -219,6 +483,14 @@ class BaseTransformer:
     def save(self, filepath):
         pass
 
+    def warm_start_from(self, filepath):
+        """
+        Note:
+            Called before refitting with the filepath of the stale transformer cached by an earlier run,
+            for example on the previous cv fold, which the fit can start from.
+        """
+        return self
+
 
 class MockTransformer(BaseTransformer):
     def fit(self, *args, **kwargs):
@@ -249,6 +521,23 @@ class Dummy(BaseTransformer):
         joblib.dump({}, filepath)
 
 
+def _compute_step(step, step_inputs, fit):
+    step_output_data = step._compute(step_inputs, fit)
+    return step_output_data, step.profile
+
+
+def _check_backend(backend):
+    if backend not in BACKENDS:
+        raise ValueError('backend {} is not supported, use one of {}'.format(backend, ', '.join(BACKENDS)))
+
+
+def _get_executor(num_workers, backend):
+    _check_backend(backend)
+    if backend == 'threading':
+        return futures.ThreadPoolExecutor(max_workers=num_workers)
+    return futures.ProcessPoolExecutor(max_workers=num_workers)
+
+
 def to_tuple_inputs(inputs):
     return tuple(inputs)
 
@@ -265,6 +554,10 @@ def hstack_inputs(inputs):
     return np.hstack(inputs)
 
 
+def hstack_feature_names_inputs(inputs):
+    return ['{}_{}'.format(i, name) for i, feature_names in enumerate(inputs) for name in feature_names]
+
+
 def vstack_inputs(inputs):
     return np.vstack(inputs)
 
@@ -0,0 +1,263 @@
+import json
+import multiprocessing
+import os
+import shutil
+from itertools import islice
+
+import numpy as np
+from gensim.models import KeyedVectors
+from sklearn.externals import joblib
+
+from steps.utils import get_logger, hash_file, hash_object
+
+logger = get_logger()
+
+
+class EmbeddingStore(object):
+    """
+    Note:
+        Pretrained word vectors converted once into a float32 .npy matrix and a vocabulary list.
+        The matrix is opened with mmap, so only the rows that are looked up get read from disk.
+    """
+
+    def __init__(self, vectors, vocabulary, mean, std):
+        self.vectors = vectors
+        self.vocabulary = vocabulary
+        self.mean = mean
+        self.std = std
+
+    @classmethod
+    def load(cls, dirpath, mmap_mode='r'):
+        metadata = joblib.load(os.path.join(dirpath, 'metadata.pkl'))
+        vectors = np.load(os.path.join(dirpath, 'vectors.npy'), mmap_mode=mmap_mode)
+        vocabulary = {word: i for i, word in enumerate(metadata['vocabulary'])}
+        return cls(vectors, vocabulary, metadata['mean'], metadata['std'])
+
+    def get_vectors(self, word_index, max_features):
+        indices, rows = [], []
+        for word, i in word_index.items():
+            if i >= max_features:
+                continue
+            row = self.vocabulary.get(word)
+            if row is not None:
+                indices.append(i)
+                rows.append(row)
+        rows = np.array(rows, dtype=np.int64)
+        order = np.argsort(rows)
+        return np.array(indices, dtype=np.int64)[order], self.vectors[rows[order]]
+
+
+def get_embedding_store(pretrained_filepath, embedding_size, store_dirpath, skip_header=False, num_workers=1):
+    dirpath = os.path.join(store_dirpath, '{}.{}d'.format(os.path.basename(pretrained_filepath), embedding_size))
+    if not os.path.exists(os.path.join(dirpath, 'metadata.pkl')):
+        logger.info('converting {} into embedding store {}'.format(pretrained_filepath, dirpath))
+        build_embedding_store(pretrained_filepath, dirpath, embedding_size, skip_header, num_workers)
+    return EmbeddingStore.load(dirpath)
+
+
+def get_word2vec_store(pretrained_filepath, store_dirpath=None):
+    """
+    Note:
+        The binary word2vec file is converted once into gensim's native format, whose vectors are
+        reloaded with mmap. Without store_dirpath the binary file is parsed into memory.
+    """
+    if store_dirpath is None:
+        model = KeyedVectors.load_word2vec_format(pretrained_filepath, binary=True, datatype=np.float32)
+        emb_mean, emb_std = model.syn0.mean(), model.syn0.std()
+    else:
+        dirpath = os.path.join(store_dirpath, '{}.kv'.format(os.path.basename(pretrained_filepath)))
+        if not os.path.exists(os.path.join(dirpath, 'metadata.pkl')):
+            logger.info('converting {} into word2vec store {}'.format(pretrained_filepath, dirpath))
+            build_word2vec_store(pretrained_filepath, dirpath)
+        model = KeyedVectors.load(os.path.join(dirpath, 'vectors.kv'), mmap='r')
+        metadata = joblib.load(os.path.join(dirpath, 'metadata.pkl'))
+        emb_mean, emb_std = metadata['mean'], metadata['std']
+    vocabulary = {word: vocab.index for word, vocab in model.vocab.items()}
+    return EmbeddingStore(model.syn0, vocabulary, emb_mean, emb_std)
+
+
+def build_word2vec_store(pretrained_filepath, dirpath):
+    tmp_dirpath = '{}.tmp'.format(dirpath)
+    shutil.rmtree(tmp_dirpath, ignore_errors=True)
+    os.makedirs(tmp_dirpath)
+
+    model = KeyedVectors.load_word2vec_format(pretrained_filepath, binary=True, datatype=np.float32)
+    model.save(os.path.join(tmp_dirpath, 'vectors.kv'))
+    joblib.dump({'mean': model.syn0.mean(), 'std': model.syn0.std()}, os.path.join(tmp_dirpath, 'metadata.pkl'))
+
+    shutil.rmtree(dirpath, ignore_errors=True)
+    os.rename(tmp_dirpath, dirpath)
+
+
+def get_cached_embedding_matrix(get_embedding_matrix, word_index, pretrained_filepath, max_features,
+                                embedding_size, store_dirpath, kind, storage_dtype='float32'):
+    """
+    Note:
+        Embedding matrices are cached in store_dirpath/matrices under a key built from the pretrained
+        file checksum, the hash of the used part of the vocabulary, max_features, embedding_size,
+        the matrix kind and the storage dtype, so pipelines and folds that share a tokenizer vocabulary
+        build it only once. Cached matrices are returned as float32.
+    """
+    vocabulary = sorted((i, word) for word, i in word_index.items() if i < max_features)
+    key = hash_object((get_file_checksum(pretrained_filepath, store_dirpath), hash_object(vocabulary),
+                       max_features, embedding_size, kind, storage_dtype))
+    filepath = os.path.join(store_dirpath, 'matrices', '{}.npy'.format(key))
+    if os.path.exists(filepath):
+        logger.info('loading cached embedding matrix {}'.format(filepath))
+        return np.load(filepath).astype(np.float32)
+
+    embedding_matrix = get_embedding_matrix().astype(storage_dtype)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    tmp_filepath = '{}.tmp.npy'.format(filepath[:-len('.npy')])
+    np.save(tmp_filepath, embedding_matrix)
+    os.rename(tmp_filepath, filepath)
+    return embedding_matrix.astype(np.float32)
+
+
+def get_file_checksum(filepath, store_dirpath):
+    """
+    Note:
+        Checksums of pretrained files are memoized in store_dirpath/checksums.json and recomputed
+        only when the file size or modification time changes.
+    """
+    checksums_filepath = os.path.join(store_dirpath, 'checksums.json')
+    checksums = {}
+    if os.path.exists(checksums_filepath):
+        with open(checksums_filepath) as f:
+            checksums = json.load(f)
+
+    stat = os.stat(filepath)
+    file_key = os.path.abspath(filepath)
+    entry = checksums.get(file_key)
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+        return entry['checksum']
+
+    checksum = hash_file(filepath)
+    checksums[file_key] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'checksum': checksum}
+    os.makedirs(store_dirpath, exist_ok=True)
+    tmp_filepath = '{}.tmp'.format(checksums_filepath)
+    with open(tmp_filepath, 'w') as f:
+        json.dump(checksums, f)
+    os.rename(tmp_filepath, checksums_filepath)
+    return checksum
+
+
+def load_vocabulary_vectors(pretrained_filepath, word_index, max_features, embedding_size, skip_header=False,
+                            chunk_size=10000):
+    """
+    Note:
+        Streams the text embedding file once in chunks of chunk_size lines and keeps only the vectors
+        of words with an index below max_features in word_index, so memory scales with the vocabulary
+        and not with the file. Mean and std are accumulated over every vector of the file, as in
+        build_embedding_store, so both loaders initialize missing words from the same distribution.
+    """
+    vocabulary = {word: i for word, i in word_index.items() if i < max_features}
+    vectors = {}
+    nr_values, total, total_squares = 0, 0.0, 0.0
+    with open(pretrained_filepath, encoding='utf-8') as f:
+        if skip_header:
+            f.readline()
+        for lines in iter(lambda: list(islice(f, chunk_size)), []):
+            words, block = _parse_lines(lines, embedding_size)
+            if block.shape[0] != len(words) * embedding_size:
+                raise ValueError('Could not parse vectors in {}'.format(pretrained_filepath))
+            block = block.reshape(-1, embedding_size)
+            nr_values += block.size
+            total += block.sum(dtype=np.float64)
+            total_squares += np.square(block, dtype=np.float64).sum()
+            for word, coefs in zip(words, block):
+                if word in vocabulary:
+                    vectors[word] = coefs.copy()
+    if not vectors:
+        raise ValueError('No vocabulary words with {} dimensional vectors found in {}'.format(embedding_size,
+                                                                                              pretrained_filepath))
+    mean = total / nr_values
+    std = np.sqrt(max(total_squares / nr_values - mean ** 2, 0.0))
+    indices = np.array([vocabulary[word] for word in vectors], dtype=np.int64)
+    return indices, np.stack(list(vectors.values())), mean, std
+
+
+def build_embedding_store(pretrained_filepath, dirpath, embedding_size, skip_header=False, num_workers=1,
+                          chunk_bytes=2 ** 26, chunk_size=100000):
+    """
+    Note:
+        The text file is cut into byte ranges aligned to line ends which are parsed in a pool of
+        num_workers processes. Parsed blocks are appended in file order to a raw float32 file and
+        copied into the .npy matrix afterwards, so the conversion never holds all vectors in memory.
+        Lines whose vector does not have embedding_size values are skipped. The store is written to
+        a temporary directory which is renamed when complete.
+    """
+    tmp_dirpath = '{}.tmp'.format(dirpath)
+    shutil.rmtree(tmp_dirpath, ignore_errors=True)
+    os.makedirs(tmp_dirpath)
+
+    raw_filepath = os.path.join(tmp_dirpath, 'vectors.raw')
+    vocabulary = []
+    byte_ranges = get_line_aligned_byte_ranges(pretrained_filepath, chunk_bytes, skip_header)
+    tasks = [(pretrained_filepath, start, end, embedding_size) for start, end in byte_ranges]
+    with multiprocessing.Pool(num_workers) as pool, open(raw_filepath, 'wb') as raw_file:
+        for words, block in pool.imap(_parse_byte_range, tasks):
+            raw_file.write(block.tobytes())
+            vocabulary.extend(words)
+    if not vocabulary:
+        shutil.rmtree(tmp_dirpath)
+        raise ValueError('No {} dimensional vectors found in {}'.format(embedding_size, pretrained_filepath))
+
+    shape = (len(vocabulary), embedding_size)
+    raw_vectors = np.memmap(raw_filepath, dtype=np.float32, mode='r', shape=shape)
+    vectors = np.lib.format.open_memmap(os.path.join(tmp_dirpath, 'vectors.npy'),
+                                        mode='w+', dtype=np.float32, shape=shape)
+    total, total_squares = 0.0, 0.0
+    for start in range(0, shape[0], chunk_size):
+        chunk = raw_vectors[start:start + chunk_size]
+        vectors[start:start + chunk_size] = chunk
+        total += chunk.sum(dtype=np.float64)
+        total_squares += np.square(chunk, dtype=np.float64).sum()
+    vectors.flush()
+    del raw_vectors, vectors
+    os.remove(raw_filepath)
+
+    nr_values = shape[0] * shape[1]
+    mean = total / nr_values
+    std = np.sqrt(max(total_squares / nr_values - mean ** 2, 0.0))
+    joblib.dump({'vocabulary': vocabulary, 'mean': mean, 'std': std}, os.path.join(tmp_dirpath, 'metadata.pkl'))
+
+    shutil.rmtree(dirpath, ignore_errors=True)
+    os.rename(tmp_dirpath, dirpath)
+
+
+def get_line_aligned_byte_ranges(filepath, chunk_bytes, skip_header=False):
+    file_size = os.path.getsize(filepath)
+    byte_ranges = []
+    with open(filepath, 'rb') as f:
+        start = len(f.readline()) if skip_header else 0
+        while start < file_size:
+            f.seek(min(start + chunk_bytes, file_size))
+            f.readline()
+            end = min(f.tell(), file_size)
+            byte_ranges.append((start, end))
+            start = end
+    return byte_ranges
+
+
+def _parse_byte_range(task):
+    filepath, start, end, embedding_size = task
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).decode('utf-8').split('\n')
+
+    words, block = _parse_lines(lines, embedding_size)
+    if block.shape[0] != len(words) * embedding_size:
+        raise ValueError('Could not parse vectors in bytes {}-{} of {}'.format(start, end, filepath))
+    return words, block.reshape(-1, embedding_size)
+
+
+def _parse_lines(lines, embedding_size):
+    words, numbers = [], []
+    for line in lines:
+        values = line.rstrip().rsplit(' ', embedding_size)
+        if len(values) != embedding_size + 1:
+            continue
+        words.append(values[0])
+        numbers.append(line[len(values[0]) + 1:])
+    return words, np.fromstring(' '.join(numbers), dtype=np.float32, sep=' ')
@@ -1,4 +1,8 @@
+from collections import Counter
+
+import numpy as np
 from keras.preprocessing import text, sequence
+from keras.utils import Sequence
 from sklearn.externals import joblib
 
 from steps.base import BaseTransformer
@@ -48,6 +52,178 @@ class Tokenizer(BaseTransformer):
         joblib.dump(object_pickle, filepath)
 
 
+class FastTokenizer(BaseTransformer):
+    """
+    Note:
+        Follows the splitting and indexing rules of keras.preprocessing.text.Tokenizer, words are ranked
+        by count with ties broken by first occurrence and index 0 is reserved for padding. After fit only
+        the num_words - 1 most frequent words are kept in word_index. Sequences are pre-padded and
+        pre-truncated directly into a preallocated int32 matrix, uint16 for char level.
+    """
+
+    def __init__(self, char_level, maxlen, num_words, filters='!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n',
+                 lower=True, split=' '):
+        self.char_level = char_level
+        self.maxlen = maxlen
+        self.num_words = num_words
+        self.filters = filters
+        self.lower = lower
+        self.split = split
+        self.translate_map = str.maketrans(filters, split * len(filters))
+        self.word_index = {}
+
+    def fit(self, X, X_valid=None, train_mode=True):
+        word_counts = Counter()
+        for x in X:
+            word_counts.update(self._to_sequence(x))
+        vocabulary = sorted(word_counts.items(), key=lambda item: item[1], reverse=True)
+        if self.num_words:
+            vocabulary = vocabulary[:self.num_words - 1]
+        self.word_index = {word: i for i, (word, _) in enumerate(vocabulary, start=1)}
+        return self
+
+    def transform(self, X, X_valid=None, train_mode=True):
+        X_tokenized = self._transform(X)
+
+        if X_valid is not None:
+            X_valid_tokenized = self._transform(X_valid)
+        else:
+            X_valid_tokenized = None
+        return {'X': X_tokenized,
+                'X_valid': X_valid_tokenized,
+                'tokenizer': self}
+
+    def _transform(self, X):
+        if self.maxlen is None:
+            token_ids = [self._to_ids(x) for x in X]
+            maxlen = max(map(len, token_ids), default=0)
+        else:
+            token_ids = map(self._to_ids, X)
+            maxlen = self.maxlen
+
+        X_tokenized = np.zeros((len(X), maxlen), dtype=self._get_dtype())
+        if maxlen == 0:
+            return X_tokenized
+        for row, ids in enumerate(token_ids):
+            ids = ids[-maxlen:]
+            if ids:
+                X_tokenized[row, maxlen - len(ids):] = ids
+        return X_tokenized
+
+    def _to_ids(self, x):
+        # empty words left by repeated separators are never in word_index, so they are dropped with the unknown ones
+        return list(filter(None, map(self.word_index.get, self._split(x))))
+
+    def _to_sequence(self, x):
+        return filter(None, self._split(x))
+
+    def _split(self, x):
+        if self.char_level:
+            return x
+        if self.lower:
+            x = x.lower()
+        return x.translate(self.translate_map).split(self.split)
+
+    def _get_dtype(self):
+        if self.char_level and len(self.word_index) < np.iinfo(np.uint16).max:
+            return np.uint16
+        return np.int32
+
+    def load(self, filepath):
+        object_pickle = joblib.load(filepath)
+        self.char_level = object_pickle['char_level']
+        self.maxlen = object_pickle['maxlen']
+        self.num_words = object_pickle['num_words']
+        self.filters = object_pickle['filters']
+        self.lower = object_pickle['lower']
+        self.split = object_pickle['split']
+        self.translate_map = str.maketrans(self.filters, self.split * len(self.filters))
+        self.word_index = object_pickle['word_index']
+        return self
+
+    def save(self, filepath):
+        object_pickle = {'char_level': self.char_level,
+                         'maxlen': self.maxlen,
+                         'num_words': self.num_words,
+                         'filters': self.filters,
+                         'lower': self.lower,
+                         'split': self.split,
+                         'word_index': self.word_index}
+        joblib.dump(object_pickle, filepath)
+
+
+class BucketingSequence(Sequence):
+    """
+    Note:
+        Serves rows of a pre-padded token matrix in batches of similar length and trims every batch
+        to its longest sequence, but not below min_length. With block_size, rows are bucketed within
+        contiguous blocks of block_size rows and the block order is shuffled, so that a memory mapped
+        X is read block by block and never loaded whole. With shuffle, rows of equal length are
+        permuted and batches rebuilt at the end of every epoch. index holds the order in which rows
+        are served, unsort maps predictions back to the input order. With sort=False rows are not
+        bucketed by length but served in input order, or in a random order with shuffle.
+    """
+
+    def __init__(self, X, y=None, batch_size=32, shuffle=False, min_length=1, block_size=None, seed=None,
+                 sort=True):
+        self.X = X
+        self.y = y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.min_length = min_length
+        self.sort = sort
+        self.block_size = block_size or len(X)
+        self.random_state = np.random.RandomState(seed)
+
+        self.lengths = np.concatenate([self._get_lengths(X[start:start + self.block_size])
+                                       for start in range(0, len(X), self.block_size)] or [np.zeros(0, np.int64)])
+        self._build_index()
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, i):
+        rows = self.batches[i]
+        maxlen = self.X.shape[1]
+        length = min(max(self.lengths[rows].max(), self.min_length), maxlen)
+        X_batch = np.asarray(self.X[rows, maxlen - length:])
+        if self.y is None:
+            return X_batch
+        return X_batch, np.asarray(self.y[rows])
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self._build_index()
+
+    def unsort(self, predictions):
+        unsorted = np.empty_like(predictions)
+        unsorted[self.index] = predictions
+        return unsorted
+
+    def _build_index(self):
+        block_starts = np.arange(0, len(self.lengths), self.block_size)
+        if self.shuffle:
+            self.random_state.shuffle(block_starts)
+
+        self.batches = []
+        for start in block_starts:
+            lengths = self.lengths[start:start + self.block_size]
+            if not self.sort:
+                block_index = self.random_state.permutation(len(lengths)) if self.shuffle else np.arange(len(lengths))
+            elif self.shuffle:
+                block_index = np.lexsort((self.random_state.rand(len(lengths)), lengths))
+            else:
+                block_index = np.argsort(lengths, kind='mergesort')
+            block_index = block_index + start
+            self.batches.extend(np.sort(block_index[i:i + self.batch_size])
+                                for i in range(0, len(block_index), self.batch_size))
+        self.index = np.concatenate(self.batches) if self.batches else np.zeros(0, np.int64)
+
+    def _get_lengths(self, X):
+        nonzero = np.asarray(X) != 0
+        return np.where(nonzero.any(axis=1), X.shape[1] - nonzero.argmax(axis=1), 0)
+
+
 class TextAugmenter(BaseTransformer):
     pass
     """
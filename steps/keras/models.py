@@ -3,10 +3,12 @@ import shutil
 import numpy as np
 from keras.models import load_model
 from sklearn.externals import joblib
-from gensim.models import KeyedVectors
 
 from steps.base import BaseTransformer
 from .contrib import AttentionWeightedAverage
+from .loaders import BucketingSequence
+from .embeddings import get_embedding_store, get_word2vec_store, get_cached_embedding_matrix, \
+    load_vocabulary_vectors
 
 
 class BasicClassifier(BaseTransformer):
@@ -51,10 +53,22 @@ class BasicClassifier(BaseTransformer):
             self.model.save(filepath)
 
     def load(self, filepath):
-        self.model = load_model(filepath,
-                                custom_objects={'AttentionWeightedAverage': AttentionWeightedAverage})
+        """
+        Note:
+            With use_cudnn set to False in model_params the model is rebuilt from its standard LSTM/GRU
+            equivalent and the saved weights, for example of a CuDNN trained checkpoint, are loaded into it.
+        """
+        if self.architecture_config['model_params'].get('use_cudnn', True):
+            self.model = load_model(filepath,
+                                    custom_objects={'AttentionWeightedAverage': AttentionWeightedAverage})
+        else:
+            self.model = self._build_model(**self._get_inference_model_params())
+            self.model.load_weights(filepath)
         return self
 
+    def _get_inference_model_params(self):
+        return dict(self.architecture_config['model_params'])
+
 
 class ClassifierXY(BasicClassifier):
     def fit(self, X, y, validation_data):
@@ -91,105 +105,135 @@ class ClassifierGenerator(BasicClassifier):
 
     def transform(self, datagen, validation_datagen=None):
         test_flow, test_steps = datagen
-        predictions = self.model.predict_generator(test_flow, test_steps, verbose=1)
+        predictions = self.model.predict_generator(test_flow, test_steps, verbose=1,
+                                                   workers=self.training_config.get('workers', 1),
+                                                   use_multiprocessing=self.training_config.get(
+                                                       'use_multiprocessing', False))
         return {'prediction_probability': predictions}
 
 
+class ClassifierBucketing(ClassifierGenerator):
+    """
+    Note:
+        Takes the same inputs as ClassifierXY but feeds ClassifierGenerator with BucketingSequence flows.
+        batch_size, shuffle and block_size are taken out of training_config. With block_size the flows
+        stream X block by block, which keeps memory flat when X is memory mapped. Bucketing is opt-in with
+        bucketing in model_params: rows are then batched by length and batches only padded to their longest
+        sequence, which the model has to accept inputs of any length for. As the leading padding is no longer
+        seen by the model its outputs change, so models trained on padded inputs should keep it off.
+        Without it every batch is padded to the full width of X as before.
+    """
+
+    def __init__(self, architecture_config, training_config, callbacks_config):
+        training_config = dict(training_config)
+        self.batch_size = training_config.pop('batch_size')
+        self.shuffle = training_config.pop('shuffle', True)
+        self.block_size = training_config.pop('block_size', None)
+        self.bucketing = bool(architecture_config['model_params'].get('bucketing', False))
+        super().__init__(architecture_config, training_config, callbacks_config)
+
+    def fit(self, X, y, validation_data):
+        X_valid, y_valid = validation_data
+        train_flow = self._get_flow(X, y, self.shuffle)
+        valid_flow = self._get_flow(X_valid, y_valid, False)
+        return super().fit((train_flow, len(train_flow)), (valid_flow, len(valid_flow)))
+
+    def transform(self, X, y=None, validation_data=None):
+        test_flow = self._get_flow(X, None, False)
+        predictions = super().transform((test_flow, len(test_flow)))['prediction_probability']
+        return {'prediction_probability': test_flow.unsort(predictions)}
+
+    def _get_flow(self, X, y, shuffle):
+        if self.bucketing:
+            return BucketingSequence(X, y, self.batch_size, shuffle, self._get_min_length(), self.block_size)
+        return BucketingSequence(X, y, self.batch_size, shuffle, X.shape[1], self.block_size, sort=False)
+
+    def _get_min_length(self):
+        return 1
+
+
 class EmbeddingsMatrix(BaseTransformer):
-    def __init__(self, pretrained_filepath, max_features, embedding_size):
+    """
+    Note:
+        Embedding matrices are float32 in memory. storage_dtype sets the dtype they are written to disk
+        with, float16 halves the size of the saved transformer and of the matrix cache. A fitted matrix is
+        rounded to storage_dtype, so it is the same as the one loaded from the saved transformer.
+    """
+
+    def __init__(self, pretrained_filepath, max_features, embedding_size, store_dirpath=None, num_workers=1,
+                 storage_dtype='float32'):
         self.pretrained_filepath = pretrained_filepath
         self.max_features = max_features
         self.embedding_size = embedding_size
+        self.store_dirpath = store_dirpath
+        self.num_workers = num_workers
+        self.storage_dtype = storage_dtype
 
     def fit(self, tokenizer):
-        self.embedding_matrix = self._get_embedding_matrix(tokenizer)
+        if self.store_dirpath is None:
+            embedding_matrix = self._get_embedding_matrix(tokenizer)
+            self.embedding_matrix = embedding_matrix.astype(self.storage_dtype).astype(np.float32)
+        else:
+            self.embedding_matrix = get_cached_embedding_matrix(lambda: self._get_embedding_matrix(tokenizer),
+                                                                tokenizer.word_index,
+                                                                self.pretrained_filepath,
+                                                                self.max_features,
+                                                                self.embedding_size,
+                                                                self.store_dirpath,
+                                                                kind=type(self).__name__,
+                                                                storage_dtype=self.storage_dtype)
         return self
 
     def transform(self, tokenizer):
         return {'embeddings_matrix': self.embedding_matrix}
 
-    def _get_embedding_matrix(self, tokenizer):
-        return NotImplementedError
-
     def save(self, filepath):
-        joblib.dump(self.embedding_matrix, filepath)
+        joblib.dump(self.embedding_matrix.astype(self.storage_dtype), filepath)
 
     def load(self, filepath):
-        self.embedding_matrix = joblib.load(filepath)
+        self.embedding_matrix = joblib.load(filepath).astype(np.float32)
         return self
 
-
-class GloveEmbeddingsMatrix(EmbeddingsMatrix):
     def _get_embedding_matrix(self, tokenizer):
-        embeddings_index = dict()
-        with open(self.pretrained_filepath) as f:
-            for line in f:
-                # Note: use split(' ') instead of split() if you get an error.
-                values = line.split(' ')
-                word = values[0]
-                coefs = np.asarray(values[1:], dtype='float32')
-                embeddings_index[word] = coefs
-
-        all_embs = np.stack(embeddings_index.values())
-        emb_mean, emb_std = all_embs.mean(), all_embs.std()
+        return NotImplementedError
 
+    def _get_pretrained_embedding_matrix(self, tokenizer, skip_header=False):
+        """
+        Note:
+            With store_dirpath the vectors are read from an mmap embedding store, which is built on first
+            use. Without it the text file is streamed and only the vectors of the tokenizer vocabulary
+            are kept. Both paths take the mean and std of random rows from all vectors of the file.
+        """
         word_index = tokenizer.word_index
-        nb_words = min(self.max_features, len(word_index))
-        embedding_matrix = np.random.normal(emb_mean, emb_std, (nb_words, self.embedding_size))
-        for word, i in word_index.items():
-            if i >= self.max_features:
-                continue
-            embedding_vector = embeddings_index.get(word)
-            if embedding_vector is not None:
-                embedding_matrix[i] = embedding_vector
+        if self.store_dirpath is None:
+            indices, embedding_vectors, emb_mean, emb_std = load_vocabulary_vectors(
+                self.pretrained_filepath, word_index, self.max_features, self.embedding_size, skip_header)
+        else:
+            store = get_embedding_store(self.pretrained_filepath, self.embedding_size, self.store_dirpath,
+                                        skip_header, self.num_workers)
+            indices, embedding_vectors = store.get_vectors(word_index, self.max_features)
+            emb_mean, emb_std = store.mean, store.std
+        return self._build_embedding_matrix(word_index, indices, embedding_vectors, emb_mean, emb_std)
+
+    def _build_embedding_matrix(self, word_index, indices, embedding_vectors, emb_mean, emb_std):
+        nb_words = min(self.max_features, len(word_index) + 1)
+        embedding_matrix = np.random.normal(emb_mean, emb_std, (nb_words, self.embedding_size)).astype(np.float32)
+        embedding_matrix[indices] = embedding_vectors
         return embedding_matrix
 
 
-class Word2VecEmbeddingsMatrix(EmbeddingsMatrix):
+class GloveEmbeddingsMatrix(EmbeddingsMatrix):
     def _get_embedding_matrix(self, tokenizer):
-        model = KeyedVectors.load_word2vec_format(self.pretrained_filepath, binary=True)
+        return self._get_pretrained_embedding_matrix(tokenizer)
 
-        emb_mean, emb_std = model.syn0.mean(), model.syn0.std()
 
-        word_index = tokenizer.word_index
-        nb_words = min(self.max_features, len(word_index))
-        embedding_matrix = np.random.normal(emb_mean, emb_std, (nb_words, self.embedding_size))
-        for word, i in word_index.items():
-            if i >= self.max_features:
-                continue
-            try:
-                embedding_vector = model[word]
-                embedding_matrix[i] = embedding_vector
-            except KeyError:
-                continue
-        return embedding_matrix
+class Word2VecEmbeddingsMatrix(EmbeddingsMatrix):
+    def _get_embedding_matrix(self, tokenizer):
+        store = get_word2vec_store(self.pretrained_filepath, self.store_dirpath)
+        indices, embedding_vectors = store.get_vectors(tokenizer.word_index, self.max_features)
+        return self._build_embedding_matrix(tokenizer.word_index, indices, embedding_vectors, store.mean, store.std)
 
 
 class FastTextEmbeddingsMatrix(EmbeddingsMatrix):
     def _get_embedding_matrix(self, tokenizer):
-        embeddings_index = dict()
-        with open(self.pretrained_filepath) as f:
-            for i, line in enumerate(f):
-                line = line.strip()
-                if i == 0:
-                    continue
-                values = line.split(' ')
-                word = values[0]
-                coefs = np.asarray(values[1:], dtype='float32')
-                if coefs.shape[0] != self.embedding_size:
-                    continue
-                embeddings_index[word] = coefs
-
-        all_embs = np.stack(embeddings_index.values())
-        emb_mean, emb_std = all_embs.mean(), all_embs.std()
-
-        word_index = tokenizer.word_index
-        nb_words = min(self.max_features, len(word_index))
-        embedding_matrix = np.random.normal(emb_mean, emb_std, (nb_words, self.embedding_size))
-        for word, i in word_index.items():
-            if i >= self.max_features:
-                continue
-            embedding_vector = embeddings_index.get(word)
-            if embedding_vector is not None:
-                embedding_matrix[i] = embedding_vector
-        return embedding_matrix
+        return self._get_pretrained_embedding_matrix(tokenizer, skip_header=True)
@@ -1,3 +1,4 @@
+import inspect
 import re
 import string
 
@@ -13,6 +14,7 @@ from nltk.tokenize import TweetTokenizer
 from nltk.stem.wordnet import WordNetLemmatizer
 from nltk.corpus import stopwords
 from .base import BaseTransformer
+from .utils import sharded_map, uses_pool, concatenate_shards, get_logger, LRUCache
 
 lem = WordNetLemmatizer()
 tokenizer = TweetTokenizer()
@@ -23,13 +25,39 @@ eng_stopwords = set(stopwords.words("english"))
 with open('external_data/apostrophes.json', 'r') as f:
     APPO = json.load(f)
 
+PUNCTUATION_PATTERN = re.compile(r'[^\w\s]')
+NEWLINE_PATTERN = re.compile('\n')
+MULTISPACE_PATTERN = re.compile(r'\s+')
+IP_PATTERN = re.compile(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}')
+USERNAME_PATTERN = re.compile(r'\[\[.*\]')
+# pandas < 0.23 has no regex argument and always treats the pattern as a regular expression
+REGEX_REPLACE = {'regex': True} if 'regex' in inspect.signature(pd.Series.str.replace).parameters else {}
+
+TOKEN_CACHE_SIZE = 2 ** 18
+TOKEN_CACHE = LRUCache(maxsize=TOKEN_CACHE_SIZE)
+
+TEXT_COUNTER_FEATURES = ['char_count', 'digit_count', 'lower_case_count', 'newline_count', 'punctuation_count',
+                         'space_count', 'upper_case_count', 'word_count', 'caps_vs_length', 'num_symbols',
+                         'num_words', 'num_unique_words', 'words_vs_unique', 'mean_word_len']
+CHAR_CLASSES = [str.isdigit,
+                str.islower,
+                lambda c: c == '\n',
+                lambda c: c in string.punctuation,
+                str.isspace,
+                str.isupper,
+                lambda c: c in '*&$%',
+                ]
+
+logger = get_logger()
+
 
 class WordListFilter(BaseTransformer):
-    def __init__(self, word_list_filepath):
+    def __init__(self, word_list_filepath, num_workers=1):
         self.word_set = self._read_data(word_list_filepath)
+        self.num_workers = num_workers
 
     def transform(self, X):
-        X = self._transform(X)
+        X = sharded_map(self._transform, X, self.num_workers)
         return {'X': X}
 
     def _transform(self, X):
@@ -56,7 +84,8 @@ class WordListFilter(BaseTransformer):
 
 class TextCleaner(BaseTransformer):
     def __init__(self, drop_punctuation, drop_newline, drop_multispaces,
-                 all_lower_case, fill_na_with, deduplication_threshold, anonymize, apostrophes, use_stopwords):
+                 all_lower_case, fill_na_with, deduplication_threshold, anonymize, apostrophes, use_stopwords,
+                 num_workers=1):
         self.drop_punctuation = drop_punctuation
         self.drop_newline = drop_newline
         self.drop_multispaces = drop_multispaces
@@ -66,15 +95,45 @@ class TextCleaner(BaseTransformer):
         self.anonymize = anonymize
         self.apostrophes = apostrophes
         self.use_stopwords = use_stopwords
+        self.num_workers = num_workers
 
     def transform(self, X):
+        if uses_pool(X, self.num_workers):
+            shards = sharded_map(self._clean_shard, X, self.num_workers, concatenate=False)
+            for _, new_entries, hits, misses in shards:
+                TOKEN_CACHE.merge(new_entries, hits, misses)
+            X = concatenate_shards([texts for texts, _, _, _ in shards])
+        else:
+            X = self._clean(X)
+        logger.info('token cache size {}, hit rate {:.3f}'.format(len(TOKEN_CACHE), TOKEN_CACHE.hit_rate))
+        return {'X': X}
+
+    def _clean(self, X):
         X = pd.DataFrame(X, columns=['text']).astype(str)
-        X['text'] = X['text'].apply(self._transform)
+        X['text'] = self._transform(X['text'])
         if self.fill_na_with:
             X['text'] = X['text'].fillna(self.fill_na_with).values
-        return {'X': X['text'].values}
+        return X['text'].values
+
+    def _clean_shard(self, X):
+        """
+        Note:
+            Runs in a worker process holding a forked copy of TOKEN_CACHE. Along with the cleaned texts
+            it returns the cache entries and hit/miss counts added by this shard, which transform merges
+            into the parent's cache so that they are logged and persisted by save.
+        """
+        known_keys = TOKEN_CACHE.keys()
+        hits, misses = TOKEN_CACHE.hits, TOKEN_CACHE.misses
+        X = self._clean(X)
+        new_entries = [(key, words) for key, words in TOKEN_CACHE.items() if key not in known_keys]
+        return X, new_entries, TOKEN_CACHE.hits - hits, TOKEN_CACHE.misses - misses
 
     def _transform(self, x):
+        """
+        Note:
+            x is the whole pandas Series of texts. Every cleaning stage is applied to all texts at once
+            with Series.str methods and precompiled patterns, tokenization runs once per text.
+        """
         if self.all_lower_case:
             x = self._lower(x)
         if self.drop_punctuation:
@@ -84,49 +143,57 @@ class TextCleaner(BaseTransformer):
         if self.drop_multispaces:
             x = self._substitute_multiple_spaces(x)
         if self.deduplication_threshold is not None:
-            x = self._deduplicate(x)
+            x = x.apply(self._deduplicate)
         if self.anonymize:
             x = self._anonymize(x)
-        if self.apostrophes:
-            x = self._apostrophes(x)
-        if self.use_stopwords:
-            x = self._use_stopwords(x)
-        return x
-
-    def _use_stopwords(self, x):
-        words = tokenizer.tokenize(x)
-        words = [w for w in words if not w in eng_stopwords]
-        x = " ".join(words)
+        if self.apostrophes or self.use_stopwords:
+            x = pd.Series([self._normalize_words(text) for text in x], index=x.index)
         return x
 
-    def _apostrophes(self, x):
+    def _normalize_words(self, x):
         words = tokenizer.tokenize(x)
-        words = [APPO[word] if word in APPO else word for word in words]
-        words = [lem.lemmatize(word, "v") for word in words]
-        words = [w for w in words if not w in eng_stopwords]
-        x = " ".join(words)
-        return x
+        words = [w for word in words for w in self._normalize_token(word)]
+        return " ".join(words)
+
+    def _normalize_token(self, word):
+        """
+        Note:
+            Normalized tokens are memoized in the module level TOKEN_CACHE, so the cache is shared
+            by all TextCleaner instances of a run and persisted by save.
+        """
+        key = (word, self.apostrophes, self.use_stopwords)
+        words = TOKEN_CACHE.get(key)
+        if words is None:
+            words = [word]
+            if self.apostrophes:
+                words = [lem.lemmatize(APPO.get(w, w), "v") for w in words]
+                words = [w for w in words if w not in eng_stopwords]
+            if self.use_stopwords:
+                # apostrophe expansions like "do not" are split, as re-tokenizing the joined text would
+                words = [w for word in words for w in word.split()]
+                words = [w for w in words if w not in eng_stopwords]
+            words = tuple(words)
+            TOKEN_CACHE.put(key, words)
+        return words
 
     def _anonymize(self, x):
         # remove leaky elements like ip,user
-        x = re.sub("\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}", " ", x)
+        x = x.str.replace(IP_PATTERN, " ", **REGEX_REPLACE)
         # removing usernames
-        x = re.sub("\[\[.*\]", " ", x)
+        x = x.str.replace(USERNAME_PATTERN, " ", **REGEX_REPLACE)
         return x
 
     def _lower(self, x):
-        return x.lower()
+        return x.str.lower()
 
     def _remove_punctuation(self, x):
-        return re.sub(r'[^\w\s]', ' ', x)
+        return x.str.replace(PUNCTUATION_PATTERN, ' ', **REGEX_REPLACE)
 
     def _remove_newline(self, x):
-        x = x.replace('\n', ' ')
-        x = x.replace('\n\n', ' ')
-        return x
+        return x.str.replace(NEWLINE_PATTERN, ' ', **REGEX_REPLACE)
 
     def _substitute_multiple_spaces(self, x):
-        return ' '.join(x.split())
+        return x.str.replace(MULTISPACE_PATTERN, ' ', **REGEX_REPLACE).str.strip()
 
     def _deduplicate(self, x):
         word_list = x.split()
@@ -145,12 +212,14 @@ class TextCleaner(BaseTransformer):
         self.drop_punctuation = params['drop_punctuation']
         self.all_lower_case = params['all_lower_case']
         self.fill_na_with = params['fill_na_with']
+        TOKEN_CACHE.update(params.get('token_cache', []))
         return self
 
     def save(self, filepath):
         params = {'drop_punctuation': self.drop_punctuation,
                   'all_lower_case': self.all_lower_case,
                   'fill_na_with': self.fill_na_with,
+                  'token_cache': TOKEN_CACHE.items(),
                   }
         joblib.dump(params, filepath)
 
@@ -192,7 +261,8 @@ class TfidfVectorizer(BaseTransformer):
         return self
 
     def transform(self, text):
-        return {'features': self.vectorizer.transform(text)}
+        return {'features': self.vectorizer.transform(text),
+                'feature_names': self.vectorizer.get_feature_names()}
 
     def load(self, filepath):
         self.vectorizer = joblib.load(filepath)
@@ -202,32 +272,89 @@ class TfidfVectorizer(BaseTransformer):
         joblib.dump(self.vectorizer, filepath)
 
 
+class HashingVectorizer(BaseTransformer):
+    """
+    Note:
+        Stateless, features of a text do not depend on the corpus, so models trained on them can be
+        updated incrementally as new texts arrive. The texts are not hashed here, features is a
+        HashedTexts view that hashes only the rows taken out of it, so a consumer reading it batch by
+        batch never holds the whole feature matrix in memory.
+    """
+
+    def __init__(self, **kwargs):
+        self.vectorizer = text.HashingVectorizer(**kwargs)
+
+    def transform(self, text):
+        return {'features': HashedTexts(self.vectorizer, text)}
+
+    def load(self, filepath):
+        self.vectorizer = joblib.load(filepath)
+        return self
+
+    def save(self, filepath):
+        joblib.dump(self.vectorizer, filepath)
+
+
+class HashedTexts(object):
+    """
+    Note:
+        Texts seen as the matrix of their hashed features. Indexing with a slice or an array of row
+        numbers hashes those texts into a CSR matrix, rows are hashed again every time they are read.
+    """
+
+    def __init__(self, vectorizer, texts):
+        self.vectorizer = vectorizer
+        self.texts = np.asarray(texts, dtype=object)
+        self.shape = (len(self.texts), vectorizer.n_features)
+
+    def __getitem__(self, rows):
+        return self.vectorizer.transform(self.texts[rows])
+
+    def __len__(self):
+        return self.shape[0]
+
+
 class TextCounter(BaseTransformer):
+    def __init__(self, num_workers=1, block_size=2000):
+        self.num_workers = num_workers
+        self.block_size = block_size
+
     def transform(self, X):
-        X = pd.DataFrame(X, columns=['text']).astype(str)
-        X = X['text'].apply(self._transform)
-        X['caps_vs_length'] = X.apply(lambda row: float(row['upper_case_count']) / float(row['char_count']), axis=1)
-        X['num_symbols'] = X['text'].apply(lambda comment: sum(comment.count(w) for w in '*&$%'))
-        X['num_words'] = X['text'].apply(lambda comment: len(comment.split()))
-        X['num_unique_words'] = X['text'].apply(lambda comment: len(set(w for w in comment.split())))
-        X['words_vs_unique'] = X['num_unique_words'] / X['num_words']
-        X['mean_word_len'] = X['text'].apply(lambda x: np.mean([len(w) for w in str(x).split()]))
-        X.drop('text', axis=1, inplace=True)
-        X.fillna(0.0, inplace=True)
+        X = sharded_map(self._count, X, self.num_workers)
         return {'X': X}
 
-    def _transform(self, x):
-        features = {}
-        features['text'] = x
-        features['char_count'] = char_count(x)
-        features['word_count'] = word_count(x)
-        features['punctuation_count'] = punctuation_count(x)
-        features['upper_case_count'] = upper_case_count(x)
-        features['lower_case_count'] = lower_case_count(x)
-        features['digit_count'] = digit_count(x)
-        features['space_count'] = space_count(x)
-        features['newline_count'] = newline_count(x)
-        return pd.Series(features)
+    def _count(self, X):
+        """
+        Note:
+            Features are written into a preallocated float32 array with columns ordered as in
+            TEXT_COUNTER_FEATURES. Texts are processed in blocks of block_size to bound the memory
+            taken by the per character arrays.
+        """
+        texts = pd.DataFrame(X, columns=['text']).astype(str)['text'].values
+        features = np.zeros((len(texts), len(TEXT_COUNTER_FEATURES)), dtype=np.float32)
+        for start in range(0, len(texts), self.block_size):
+            block = texts[start:start + self.block_size]
+            features[start:start + len(block)] = self._count_block(block)
+        return features
+
+    def _count_block(self, texts):
+        char_count = np.array([len(text) for text in texts], dtype=np.int64)
+        word_lists = [text.split() for text in texts]
+        num_words = np.array([len(words) for words in word_lists], dtype=np.int64)
+        num_unique_words = np.array([len(set(words)) for words in word_lists], dtype=np.int64)
+        digit_count, lower_case_count, newline_count, punctuation_count, space_count, upper_case_count, \
+            num_symbols = count_char_classes(texts, char_count).T
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            caps_vs_length = upper_case_count / char_count
+            words_vs_unique = num_unique_words / num_words
+            mean_word_len = (char_count - space_count) / num_words
+
+        features = np.column_stack([char_count, digit_count, lower_case_count, newline_count, punctuation_count,
+                                    space_count, upper_case_count, num_words, caps_vs_length, num_symbols,
+                                    num_words, num_unique_words, words_vs_unique, mean_word_len])
+        features[np.isnan(features)] = 0.0
+        return features
 
     def load(self, filepath):
         return self
@@ -300,37 +427,18 @@ class MinMaxScalerMultilabel(BaseTransformer):
         joblib.dump(self.minmax_scalers, filepath)
 
 
-def char_count(x):
-    return len(x)
-
-
-def word_count(x):
-    return len(x.split())
-
-
-def newline_count(x):
-    return x.count('\n')
-
-
-def upper_case_count(x):
-    return sum(c.isupper() for c in x)
-
-
-def lower_case_count(x):
-    return sum(c.islower() for c in x)
-
-
-def digit_count(x):
-    return sum(c.isdigit() for c in x)
-
-
-def space_count(x):
-    return sum(c.isspace() for c in x)
-
-
-def punctuation_count(x):
-    return occurence(x, string.punctuation)
-
-
-def occurence(s1, s2):
-    return sum([1 for x in s1 if x in s2])
+def count_char_classes(texts, lengths):
+    """
+    Note:
+        All texts are concatenated into one array of code points. Every distinct character is classified
+        once against CHAR_CLASSES and per text counts are read off a cumulative sum at the text boundaries.
+    """
+    codes = np.frombuffer(''.join(texts).encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+    chars, inverse = np.unique(codes, return_inverse=True)
+    char_classes = np.array([[char_class(chr(char)) for char_class in CHAR_CLASSES] for char in chars],
+                            dtype=np.int32).reshape(-1, len(CHAR_CLASSES))
+    cumulative_counts = np.zeros((len(codes) + 1, len(CHAR_CLASSES)), dtype=np.int64)
+    np.cumsum(char_classes[inverse], axis=0, out=cumulative_counts[1:])
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    return cumulative_counts[ends] - cumulative_counts[starts]
@@ -1,10 +1,17 @@
+import hashlib
+import multiprocessing
+
 import numpy as np
 import sklearn.linear_model as lr
+from scipy import sparse
+from scipy.special import expit
 from sklearn import svm
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.externals import joblib
-from catboost import CatBoostClassifier
-from xgboost import XGBClassifier
+from sklearn.model_selection import cross_val_predict
+from sklearn.utils import check_array
+from catboost import CatBoostClassifier, Pool
+from xgboost import XGBClassifier, DMatrix, train as xgb_train
 
 from steps.base import BaseTransformer
 from steps.utils import get_logger
@@ -13,8 +20,21 @@ logger = get_logger()
 
 
 class MultilabelEstimator(BaseTransformer):
-    def __init__(self, label_nr, **kwargs):
+    """
+    Note:
+        X is converted once into the format the estimators work on, CSR or C ordered float64 for
+        sklearn estimators, and shared by all labels and by the predictions of fit_transform.
+        Label estimators are fitted and predicted concurrently by joblib with the threading or
+        multiprocessing backend. num_workers is the thread budget of the whole step: when the estimator
+        threads are not set in kwargs, each of min(label_nr, num_workers) label workers gets an equal
+        share of it, otherwise only as many label workers run as the estimator threads leave room for.
+    """
+    jobs_param = 'n_jobs'
+
+    def __init__(self, label_nr, num_workers=1, backend='threading', **kwargs):
         self.label_nr = label_nr
+        self.backend = backend
+        self.label_workers, kwargs = self._split_thread_budget(num_workers, kwargs)
         self.estimators = self._get_estimators(**kwargs)
 
     @property
@@ -27,20 +47,45 @@ class MultilabelEstimator(BaseTransformer):
             estimators.append((i, self.estimator(**kwargs)))
         return estimators
 
+    def _split_thread_budget(self, num_workers, kwargs):
+        kwargs = dict(kwargs)
+        estimator_jobs = kwargs.get(self.jobs_param) if self.jobs_param else 1
+        if estimator_jobs is None:
+            label_workers = max(1, min(self.label_nr, num_workers))
+            kwargs[self.jobs_param] = max(1, num_workers // label_workers)
+        else:
+            if estimator_jobs < 1:
+                estimator_jobs = multiprocessing.cpu_count()
+            label_workers = max(1, min(self.label_nr, num_workers // estimator_jobs))
+        return label_workers, kwargs
+
+    def _get_parallel(self):
+        return joblib.Parallel(n_jobs=self.label_workers, backend=self.backend)
+
     def fit(self, X, y, **kwargs):
-        for i, estimator in self.estimators:
-            logger.info('fitting estimator {}'.format(i))
-            estimator.fit(X, y[:, i])
+        self._fit(self._get_features(X), y)
         return self
 
     def transform(self, X, y=None, **kwargs):
-        predictions = []
-        for i, estimator in self.estimators:
-            prediction = estimator.predict_proba(X)
-            predictions.append(prediction)
+        return {'prediction_probability': self._predict(self._get_features(X))}
+
+    def fit_transform(self, X, y, **kwargs):
+        features = self._get_features(X)
+        self._fit(features, y)
+        return {'prediction_probability': self._predict(features)}
+
+    def _get_features(self, X):
+        return check_array(X, accept_sparse='csr', dtype=np.float64, order='C')
+
+    def _fit(self, features, y):
+        self.estimators = self._get_parallel()(joblib.delayed(_fit_estimator)(i, estimator, features, y[:, i])
+                                               for i, estimator in self.estimators)
+
+    def _predict(self, features):
+        predictions = self._get_parallel()(joblib.delayed(_predict_proba)(estimator, features)
+                                           for _, estimator in self.estimators)
         predictions = np.stack(predictions, axis=0)
-        predictions = predictions[:, :, 1].transpose()
-        return {'prediction_probability': predictions}
+        return predictions[:, :, 1].transpose()
 
     def load(self, filepath):
         params = joblib.load(filepath)
@@ -55,33 +100,251 @@ class MultilabelEstimator(BaseTransformer):
 
 
 class LogisticRegressionMultilabel(MultilabelEstimator):
+    """
+    Note:
+        With warm_start the label solvers start from the coefficients of the stale cached transformer,
+        which in cv is the one fitted on the previous fold. Refitted vectorizers reorder their columns,
+        so coefficients are aligned by feature_names and the warm start is skipped when the names of either
+        fit are unknown. Features new to this fit start from zero. A warm started solver that stops at
+        max_iter is refitted from zero, so an unconverged solution never depends on the previous fit,
+        which in cv has seen the current validation rows. The solver iterations of each label are logged.
+    """
+
+    def __init__(self, label_nr, num_workers=1, backend='threading', **kwargs):
+        super().__init__(label_nr, num_workers=num_workers, backend=backend, **kwargs)
+        self.feature_names = None
+        self.previous_fit = None
+
     @property
     def estimator(self):
         return lr.LogisticRegression
 
+    def fit(self, X, y, feature_names=None, **kwargs):
+        self.feature_names = feature_names
+        return super().fit(X, y)
+
+    def fit_transform(self, X, y, feature_names=None, **kwargs):
+        self.feature_names = feature_names
+        return super().fit_transform(X, y)
+
+    def warm_start_from(self, filepath):
+        if all(estimator.warm_start for _, estimator in self.estimators):
+            self.previous_fit = joblib.load(filepath)
+        return self
+
+    def _fit(self, features, y):
+        warm_started = self._warm_start()
+        super()._fit(features, y)
+        not_converged = [(i, estimator) for i, estimator in self.estimators
+                         if i in warm_started and np.max(estimator.n_iter_) >= estimator.max_iter]
+        if not_converged:
+            logger.info('warm started estimators {} did not converge, refitting them from zero'.format(
+                [i for i, _ in not_converged]))
+            for _, estimator in not_converged:
+                del estimator.coef_, estimator.intercept_
+            refitted = dict(self._get_parallel()(joblib.delayed(_fit_estimator)(i, estimator, features, y[:, i])
+                                                 for i, estimator in not_converged))
+            self.estimators = [(i, refitted.get(i, estimator)) for i, estimator in self.estimators]
+        for i, estimator in self.estimators:
+            logger.info('estimator {} solver iterations {}'.format(i, int(np.max(estimator.n_iter_))))
+
+    def _warm_start(self):
+        previous_fit, self.previous_fit = self.previous_fit, None
+        if previous_fit is None:
+            return set()
+        previous_feature_names = previous_fit.get('feature_names')
+        if previous_feature_names is None or self.feature_names is None:
+            logger.info('feature names are unknown, estimators are not warm started')
+            return set()
+
+        previous_columns = {name: column for column, name in enumerate(previous_feature_names)}
+        columns = np.array([previous_columns.get(name, -1) for name in self.feature_names], dtype=np.int64)
+        known = columns >= 0
+        logger.info('warm starting estimators on {} of {} features'.format(int(known.sum()), len(columns)))
+
+        previous_estimators = dict(previous_fit['estimators'])
+        warm_started = set()
+        for i, estimator in self.estimators:
+            previous_estimator = previous_estimators.get(i)
+            if not hasattr(previous_estimator, 'coef_'):
+                continue
+            coef = np.zeros((previous_estimator.coef_.shape[0], len(columns)))
+            coef[:, known] = previous_estimator.coef_[:, columns[known]]
+            estimator.coef_ = coef
+            estimator.intercept_ = previous_estimator.intercept_
+            warm_started.add(i)
+        return warm_started
+
+    def load(self, filepath):
+        params = joblib.load(filepath)
+        self.label_nr = params['label_nr']
+        self.estimators = params['estimators']
+        self.feature_names = params.get('feature_names')
+        return self
+
+    def save(self, filepath):
+        params = {'label_nr': self.label_nr,
+                  'estimators': self.estimators,
+                  'feature_names': self.feature_names}
+        joblib.dump(params, filepath)
+
+
+class SGDClassifierMultilabel(MultilabelEstimator):
+    """
+    Note:
+        Label SGDClassifiers are trained with partial_fit on batches of batch_size rows, visited in a
+        shuffled order in each of the epochs. X can be a matrix or a tuple of matrices which are stacked
+        batch by batch, so memory mapped step outputs and hashed texts are read one batch at a time.
+        Predictions are made batch by batch as well. With incremental the learned state of the stale
+        cached transformer is copied into the configured estimators and the epochs run only over the
+        rows it has not been trained on, recognized by a digest of their features. New labels of rows
+        that were seen before are not learned. The previous state is dropped and all rows are trained on
+        when the number of features changed or the previous model kept no row digests.
+        Incremental training must not be used across cv folds, where the previous model has seen the
+        rows of the current validation fold.
+    """
+    learned_state = ('coef_', 'intercept_', 't_', 'classes_',
+                     'standard_coef_', 'standard_intercept_', 'average_coef_', 'average_intercept_')
+
+    def __init__(self, label_nr, batch_size=10000, epochs=5, incremental=False, num_workers=1,
+                 backend='threading', **kwargs):
+        self.batch_size = batch_size
+        self.epochs = epochs
+        self.incremental = incremental
+        self.random_state = kwargs.get('random_state')
+        self.row_digests = None
+        super().__init__(label_nr, num_workers=num_workers, backend=backend, **kwargs)
+
+    @property
+    def estimator(self):
+        return lr.SGDClassifier
+
+    def warm_start_from(self, filepath):
+        if not self.incremental:
+            return self
+        logger.info('continuing training of estimators from {}'.format(filepath))
+        params = joblib.load(filepath)
+        previous_estimators = dict(params['estimators'])
+        for i, estimator in self.estimators:
+            previous_estimator = previous_estimators.get(i)
+            for attribute in self.learned_state:
+                if hasattr(previous_estimator, attribute):
+                    setattr(estimator, attribute, getattr(previous_estimator, attribute))
+        self.row_digests = params.get('row_digests')
+        return self
+
+    def _get_features(self, X):
+        return X
+
+    def _get_batches(self, rows):
+        return [rows[start:start + self.batch_size] for start in range(0, len(rows), self.batch_size)]
+
+    def _fit(self, features, y):
+        rows = np.arange(_get_nr_rows(features))
+        row_digests = self._get_row_digests(features, rows) if self.incremental else None
+        if self._drop_learned_state(features):
+            self.row_digests = None
+        if self.row_digests is not None:
+            rows = rows[~np.isin(row_digests, self.row_digests)]
+            logger.info('training on {} rows that the previous model has not seen'.format(len(rows)))
+            row_digests = np.union1d(self.row_digests, row_digests)
+        self.row_digests = row_digests
+
+        classes = np.unique(y)
+        batches = self._get_batches(rows)
+        random_state = np.random.RandomState(self.random_state)
+        with self._get_parallel() as parallel:
+            for epoch in range(self.epochs if batches else 0):
+                logger.info('epoch {}'.format(epoch))
+                for batch_nr in random_state.permutation(len(batches)):
+                    batch = batches[batch_nr]
+                    X_batch = _get_rows(features, batch)
+                    self.estimators = parallel(
+                        joblib.delayed(_partial_fit_estimator)(i, estimator, X_batch, y[batch, i], classes)
+                        for i, estimator in self.estimators)
+
+    def _drop_learned_state(self, features):
+        nr_columns = _get_nr_columns(features)
+        dropped = False
+        for i, estimator in self.estimators:
+            if hasattr(estimator, 'coef_') and estimator.coef_.shape[1] != nr_columns:
+                logger.info('number of features changed, estimator {} is trained from scratch'.format(i))
+                for attribute in self.learned_state:
+                    if hasattr(estimator, attribute):
+                        delattr(estimator, attribute)
+                dropped = True
+        return dropped
+
+    def _get_row_digests(self, features, rows):
+        row_digests = [_get_row_digests(_get_rows(features, batch)) for batch in self._get_batches(rows)]
+        return np.concatenate([np.zeros(0, dtype=np.uint64)] + row_digests)
+
+    def _predict(self, features):
+        predictions = [np.zeros((0, self.label_nr))]
+        with self._get_parallel() as parallel:
+            for start in range(0, _get_nr_rows(features), self.batch_size):
+                X_batch = _get_rows(features, slice(start, start + self.batch_size))
+                batch_predictions = parallel(joblib.delayed(_predict_proba)(estimator, X_batch)
+                                             for _, estimator in self.estimators)
+                predictions.append(np.stack(batch_predictions, axis=0)[:, :, 1].transpose())
+        return np.vstack(predictions)
+
+    def load(self, filepath):
+        params = joblib.load(filepath)
+        self.label_nr = params['label_nr']
+        self.estimators = params['estimators']
+        self.row_digests = params.get('row_digests')
+        return self
+
+    def save(self, filepath):
+        params = {'label_nr': self.label_nr,
+                  'estimators': self.estimators,
+                  'row_digests': self.row_digests}
+        joblib.dump(params, filepath)
+
 
 class SVCMultilabel(MultilabelEstimator):
+    jobs_param = None
+
     @property
     def estimator(self):
         return svm.SVC
 
 
 class LinearSVC_proba(svm.LinearSVC):
-    def __platt_func(self, x):
-        return 1 / (1 + np.exp(-x))
+    """
+    Note:
+        LinearSVC with Platt scaling. A and B of the sigmoid 1 / (1 + exp(A * f + B)) are fitted with
+        the Newton method of Lin, Lin and Weng on decision values f predicted out of fold by platt_cv
+        fold models, after which the svm itself is fitted on the whole X. Binary targets only.
+    """
+
+    def __init__(self, penalty='l2', loss='squared_hinge', dual=True, tol=1e-4, C=1.0, multi_class='ovr',
+                 fit_intercept=True, intercept_scaling=1, class_weight=None, verbose=0, random_state=None,
+                 max_iter=1000, platt_cv=3):
+        super().__init__(penalty=penalty, loss=loss, dual=dual, tol=tol, C=C, multi_class=multi_class,
+                         fit_intercept=fit_intercept, intercept_scaling=intercept_scaling,
+                         class_weight=class_weight, verbose=verbose, random_state=random_state,
+                         max_iter=max_iter)
+        self.platt_cv = platt_cv
+
+    def fit(self, X, y, sample_weight=None):
+        svc_params = {key: value for key, value in self.get_params().items() if key != 'platt_cv'}
+        fit_params = {'sample_weight': sample_weight} if sample_weight is not None else None
+        decision_values = cross_val_predict(svm.LinearSVC(**svc_params), X, y, cv=self.platt_cv,
+                                            method='decision_function', fit_params=fit_params)
+        super().fit(X, y, sample_weight=sample_weight)
+        self.platt_a_, self.platt_b_ = _fit_platt_sigmoid(decision_values, y == self.classes_[1])
+        return self
 
     def predict_proba(self, X):
-        f = np.vectorize(self.__platt_func)
-        raw_predictions = self.decision_function(X)
-        platt_predictions = f(raw_predictions).reshape(-1, 1)
-        prob_positive = platt_predictions / platt_predictions.sum(axis=1)[:, None]
-        prob_negative = 1.0 - prob_positive
-        probs = np.hstack([prob_negative, prob_positive])
-        print(prob_positive)
-        return probs
+        prob_positive = expit(-(self.decision_function(X) * self.platt_a_ + self.platt_b_))
+        return np.column_stack([1.0 - prob_positive, prob_positive])
 
 
 class LinearSVCMultilabel(MultilabelEstimator):
+    jobs_param = None
+
     @property
     def estimator(self):
         return LinearSVC_proba
@@ -94,12 +357,160 @@ class RandomForestMultilabel(MultilabelEstimator):
 
 
 class CatboostClassifierMultilabel(MultilabelEstimator):
+    """
+    Note:
+        Features are converted once to a C ordered float32 Pool on which the label models are trained
+        one after another by swapping its labels, so labels are not run concurrently and the whole thread
+        budget goes to catboost when thread_count is not set. The pinned catboost has no public setter
+        for the labels of a Pool, so the private _set_label that Pool uses on construction is called.
+        Predictions are read from the same Pool.
+    """
+    jobs_param = 'thread_count'
+
     @property
     def estimator(self):
         return CatBoostClassifier
 
+    def _split_thread_budget(self, num_workers, kwargs):
+        kwargs = dict(kwargs)
+        kwargs.setdefault(self.jobs_param, num_workers)
+        return 1, kwargs
+
+    def fit(self, X, y, **kwargs):
+        self._fit(self._get_features(X, y), y)
+        return self
+
+    def fit_transform(self, X, y, **kwargs):
+        features = self._get_features(X, y)
+        self._fit(features, y)
+        return {'prediction_probability': self._predict(features)}
+
+    def _get_features(self, X, y=None):
+        label = y[:, 0] if y is not None else None
+        return Pool(np.ascontiguousarray(X, dtype=np.float32), label=label)
+
+    def _fit(self, features, y):
+        for i, estimator in self.estimators:
+            logger.info('fitting estimator {}'.format(i))
+            features._set_label(y[:, i])
+            estimator.fit(features)
+
 
 class XGBoostClassifierMultilabel(MultilabelEstimator):
+    """
+    Note:
+        Features are converted once to a DMatrix on which the label boosters are trained one after
+        another by swapping its labels, so labels are not run concurrently and the whole thread budget
+        goes to xgboost when n_jobs is not set. Predictions are read from the boosters on the same DMatrix.
+    """
+
     @property
     def estimator(self):
         return XGBClassifier
+
+    def _split_thread_budget(self, num_workers, kwargs):
+        kwargs = dict(kwargs)
+        kwargs.setdefault(self.jobs_param, num_workers)
+        return 1, kwargs
+
+    def _get_features(self, X):
+        _, estimator = self.estimators[0]
+        return DMatrix(X, missing=estimator.missing, nthread=estimator.n_jobs)
+
+    def _fit(self, features, y):
+        for i, estimator in self.estimators:
+            logger.info('fitting estimator {}'.format(i))
+            features.set_label(y[:, i])
+            estimator._Booster = xgb_train(estimator.get_xgb_params(), features, estimator.n_estimators)
+            estimator.classes_ = np.unique(y[:, i])
+            estimator.n_classes_ = len(estimator.classes_)
+
+    def _predict(self, features):
+        predictions = [estimator.get_booster().predict(features) for _, estimator in self.estimators]
+        return np.stack(predictions, axis=1)
+
+
+def _fit_estimator(i, estimator, X, y):
+    logger.info('fitting estimator {}'.format(i))
+    estimator.fit(X, y)
+    return i, estimator
+
+
+def _predict_proba(estimator, X):
+    return estimator.predict_proba(X)
+
+
+def _partial_fit_estimator(i, estimator, X, y, classes):
+    estimator.partial_fit(X, y, classes=classes)
+    return i, estimator
+
+
+def _get_rows(X, rows):
+    if isinstance(X, (list, tuple)):
+        return sparse.hstack([x[rows] for x in X], format='csr')
+    return X[rows]
+
+
+def _get_row_digests(X):
+    X = sparse.csr_matrix(X).sorted_indices()
+    row_digests = np.zeros(X.shape[0], dtype=np.uint64)
+    for row in range(X.shape[0]):
+        start, end = X.indptr[row], X.indptr[row + 1]
+        digest = hashlib.md5(X.indices[start:end].astype(np.int64).tobytes() +
+                             X.data[start:end].astype(np.float64).tobytes()).digest()
+        row_digests[row] = np.frombuffer(digest[:8], dtype=np.uint64)[0]
+    return row_digests
+
+
+def _get_nr_rows(X):
+    if isinstance(X, (list, tuple)):
+        X = X[0]
+    return X.shape[0]
+
+
+def _get_nr_columns(X):
+    if isinstance(X, (list, tuple)):
+        return sum(x.shape[1] for x in X)
+    return X.shape[1]
+
+
+def _fit_platt_sigmoid(decision_values, positive, max_iter=100, min_step=1e-10, sigma=1e-12, eps=1e-5):
+    decision_values = np.asarray(decision_values, dtype=np.float64)
+    positive = np.asarray(positive, dtype=bool)
+    prior1 = float(positive.sum())
+    prior0 = float(len(positive)) - prior1
+    targets = np.where(positive, (prior1 + 1.0) / (prior1 + 2.0), 1.0 / (prior0 + 2.0))
+
+    def loss(a, b):
+        f_ab = decision_values * a + b
+        return np.sum(targets * f_ab + np.logaddexp(0.0, -f_ab))
+
+    a, b = 0.0, np.log((prior0 + 1.0) / (prior1 + 1.0))
+    value = loss(a, b)
+    for _ in range(max_iter):
+        p = expit(-(decision_values * a + b))
+        d1 = targets - p
+        d2 = p * (1.0 - p)
+        g1, g2 = np.dot(decision_values, d1), d1.sum()
+        if abs(g1) < eps and abs(g2) < eps:
+            break
+        h11 = sigma + np.dot(decision_values * decision_values, d2)
+        h22 = sigma + d2.sum()
+        h21 = np.dot(decision_values, d2)
+        det = h11 * h22 - h21 * h21
+        da = -(h22 * g1 - h21 * g2) / det
+        db = -(-h21 * g1 + h11 * g2) / det
+        gd = g1 * da + g2 * db
+
+        step = 1.0
+        while step >= min_step:
+            new_a, new_b = a + step * da, b + step * db
+            new_value = loss(new_a, new_b)
+            if new_value < value + 1e-4 * step * gd:
+                a, b, value = new_a, new_b, new_value
+                break
+            step /= 2.0
+        else:
+            logger.info('platt scaling line search failed')
+            break
+    return a, b
@@ -1,8 +1,21 @@
+import hashlib
 import logging
+import multiprocessing
 import os
+import resource
+import shutil
+import threading
+from collections import OrderedDict
 
+import numpy as np
+import pandas as pd
 import pydot_ng as pydot
 from IPython.display import Image, display
+from scipy import sparse
+from sklearn.externals import joblib
+
+
+EXECUTION_PARAMS = ('num_workers', 'backend')
 
 
 def view_pydot(pydot_object):
@@ -10,10 +23,14 @@ def view_pydot(pydot_object):
     display(plt)
 
 
-def create_graph(graph_info):
+def create_graph(graph_info, node_labels=None):
+    node_labels = node_labels or {}
     dot = pydot.Dot()
     for node in graph_info['nodes']:
-        dot.add_node(pydot.Node(node))
+        if node in node_labels:
+            dot.add_node(pydot.Node(node, label='"{}"'.format(node_labels[node])))
+        else:
+            dot.add_node(pydot.Node(node))
     for node1, node2 in graph_info['edges']:
         dot.add_edge(pydot.Edge(node1, node2))
     return dot
@@ -24,11 +41,251 @@ def view_graph(graph_info):
     view_pydot(graph)
 
 
-def plot_graph(graph_info, filepath):
-    graph = create_graph(graph_info)
+def plot_graph(graph_info, filepath, node_labels=None):
+    graph = create_graph(graph_info, node_labels)
     graph.write(filepath, format='png')
 
 
+def get_peak_rss():
+    """Peak resident set size of the process in bytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_path_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(dirpath, filename))
+    return size
+
+
+def get_output_size(output_data):
+    """Bytes held by the arrays and sparse matrices of a step output"""
+    size = 0
+    for value in (output_data or {}).values():
+        if isinstance(value, np.ndarray):
+            size += value.nbytes
+        elif sparse.issparse(value):
+            size += sum(getattr(value, component).nbytes for component in ['data', 'indices', 'indptr', 'row', 'col']
+                        if hasattr(value, component))
+        elif isinstance(value, pd.DataFrame):
+            size += int(value.memory_usage(index=False).sum())
+        elif isinstance(value, pd.Series):
+            size += value.nbytes
+    return size
+
+
+def format_profile(profile):
+    columns = ['name', 'cache', 'wall_time', 'cpu_time', 'peak_rss_delta', 'output_size', 'bytes_read',
+               'bytes_written']
+    rows = [columns]
+    for step_profile in profile:
+        rows.append([step_profile['name'],
+                     step_profile['cache'],
+                     '{:.2f}s'.format(step_profile['wall_time']),
+                     '{:.2f}s'.format(step_profile['cpu_time']),
+                     _format_bytes(step_profile['peak_rss_delta']),
+                     _format_bytes(step_profile['output_size']),
+                     _format_bytes(step_profile['bytes_read']),
+                     _format_bytes(step_profile['bytes_written'])])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return '\n'.join('  '.join(cell.ljust(width) for cell, width in zip(row, widths)) for row in rows)
+
+
+def format_profile_label(step_profile):
+    # graphviz renders the escaped \n as a line break
+    return '{}\\n{:.1f}s wall, {:.1f}s cpu\\n+{} rss, {} out\\ncache {}'.format(
+        step_profile['name'], step_profile['wall_time'], step_profile['cpu_time'],
+        _format_bytes(step_profile['peak_rss_delta']), _format_bytes(step_profile['output_size']),
+        step_profile['cache'])
+
+
+def _format_bytes(nr_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(nr_bytes) < 1024:
+            return '{:.1f}{}'.format(nr_bytes, unit)
+        nr_bytes /= 1024
+    return '{:.1f}TB'.format(nr_bytes)
+
+
+def hash_object(obj):
+    return joblib.hash(obj)
+
+
+def hash_file(filepath, chunk_size=2 ** 20):
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_transformer_fingerprint(transformer):
+    transformer_class = type(transformer)
+    init_params = getattr(transformer, 'init_params', None)
+    if init_params is not None:
+        kwargs = {key: value for key, value in init_params['kwargs'].items() if key not in EXECUTION_PARAMS}
+        init_params = {'args': init_params['args'], 'kwargs': kwargs}
+    return hash_object(('{}.{}'.format(transformer_class.__module__, transformer_class.__name__), init_params))
+
+
+def sharded_map(func, X, num_workers=1, shards_per_worker=4, concatenate=True):
+    """
+    Note:
+        X is split along the first axis into shards which are mapped with func in a pool of num_workers
+        processes. Shard results are concatenated back in input order, so func has to return an array,
+        Series or DataFrame with one row per input row. func is pickled together with its bound instance.
+        With concatenate=False the list of shard results is returned instead, which lets func send back
+        state gathered in the worker. uses_pool tells whether func runs in worker processes at all.
+    """
+    if not uses_pool(X, num_workers):
+        result = func(X)
+        return result if concatenate else [result]
+    nr_shards = min(len(X), num_workers * shards_per_worker)
+    shards = np.array_split(X, nr_shards)
+    with multiprocessing.Pool(num_workers) as pool:
+        results = pool.map(func, shards)
+    return concatenate_shards(results) if concatenate else results
+
+
+def uses_pool(X, num_workers):
+    return num_workers > 1 and len(X) > 1
+
+
+def concatenate_shards(shards):
+    if isinstance(shards[0], (pd.DataFrame, pd.Series)):
+        return pd.concat(shards, ignore_index=True)
+    return np.concatenate(shards)
+
+
+class LRUCache(object):
+    """
+    Note:
+        Bounded least recently used cache with hit and miss counters. Access is guarded by a lock
+        so that steps running in the threading backend can share one instance. The lock is dropped
+        when pickling, which lets the cache travel to worker processes and be persisted.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def update(self, items):
+        for key, value in items:
+            self.put(key, value)
+
+    def items(self):
+        with self._lock:
+            return list(self._data.items())
+
+    def keys(self):
+        with self._lock:
+            return set(self._data)
+
+    def merge(self, items, hits, misses):
+        """
+        Note:
+            Adds entries and hit/miss counts gathered by a copy of this cache in a worker process.
+        """
+        self.update(items)
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+def save_output(output_data, dirpath):
+    """
+    Note:
+        Dense numeric arrays are stored as .npy files and sparse matrices as their CSR component arrays,
+        so that load_output can memory map them. Everything else (object arrays, tokenizers, flags)
+        is pickled into a single metadata file. The output is written to a temporary directory
+        and renamed at the end, so a partially written output is never picked up from cache.
+    """
+    tmp_dirpath = '{}.tmp'.format(dirpath)
+    shutil.rmtree(tmp_dirpath, ignore_errors=True)
+    os.makedirs(tmp_dirpath)
+
+    metadata = {'dense': [], 'sparse': {}, 'objects': {}}
+    for name, value in output_data.items():
+        if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+            np.save(os.path.join(tmp_dirpath, '{}.npy'.format(name)), value)
+            metadata['dense'].append(name)
+        elif sparse.issparse(value):
+            value_format = value.format
+            if value_format not in ['csr', 'csc']:
+                value = value.tocsr()
+            for component in ['data', 'indices', 'indptr']:
+                np.save(os.path.join(tmp_dirpath, '{}.{}.npy'.format(name, component)), getattr(value, component))
+            metadata['sparse'][name] = {'shape': value.shape,
+                                        'stored_format': value.format,
+                                        'format': value_format}
+        else:
+            metadata['objects'][name] = value
+    joblib.dump(metadata, os.path.join(tmp_dirpath, 'metadata.pkl'))
+
+    shutil.rmtree(dirpath, ignore_errors=True)
+    os.rename(tmp_dirpath, dirpath)
+
+
+def load_output(dirpath, mmap_mode=None):
+    metadata = joblib.load(os.path.join(dirpath, 'metadata.pkl'))
+    output_data = dict(metadata['objects'])
+    for name in metadata['dense']:
+        output_data[name] = np.load(os.path.join(dirpath, '{}.npy'.format(name)), mmap_mode=mmap_mode)
+    for name, sparse_info in metadata['sparse'].items():
+        data, indices, indptr = [np.load(os.path.join(dirpath, '{}.{}.npy'.format(name, component)),
+                                         mmap_mode=mmap_mode)
+                                 for component in ['data', 'indices', 'indptr']]
+        if sparse_info['stored_format'] == 'csr':
+            value = sparse.csr_matrix((data, indices, indptr), shape=sparse_info['shape'], copy=False)
+        else:
+            value = sparse.csc_matrix((data, indices, indptr), shape=sparse_info['shape'], copy=False)
+        if sparse_info['format'] != sparse_info['stored_format']:
+            value = value.asformat(sparse_info['format'])
+        output_data[name] = value
+    return output_data
+
+
 def create_filepath(filepath):
     dirpath = os.path.dirname(filepath)
     os.makedirs(dirpath, exist_ok=True)